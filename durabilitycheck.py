@@ -0,0 +1,203 @@
+"""Checks what each session durability policy guarantees when the bot
+crashes, for both the .jsonl journals and the SQLite session store.  For every
+policy, a child process appends messages to a session and acknowledges each
+one once the session says it has been written; it is then killed with SIGKILL
+and the session is read back to see which messages survived.  A clean run
+that closes the session is checked as well.
+
+    python durabilitycheck.py
+    python durabilitycheck.py --messages 200 --delay 5 --store sqlite group
+
+A kill can't simulate a power failure, so what each policy would lose in one
+is checked through the number of fsyncs done before each acknowledgement.
+SQLite does its fsyncs itself, so for the SQLite store the syncs the store
+asks the writer thread for are counted instead.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date
+from pathlib import Path
+
+from lib import journal
+from lib.msgtypes import UserMessage
+from lib.store import SessionDatabase
+
+STORES = ('jsonl', 'sqlite')
+
+# The date of the session written to the SQLite store
+SESSION_DATE = date(2024, 1, 1)
+
+
+def check_fsyncs(policy, acked, fsyncs, elapsed, interval):
+    """Returns a description of how the fsyncs done while acknowledging
+    messages break the guarantees of the policy, or None."""
+
+    if policy == 'message' and fsyncs < acked:
+        return f"only {fsyncs} fsyncs for {acked} acknowledged messages"
+
+    # One per interval, plus one for an interval that had started
+    if policy == 'group' and fsyncs > elapsed / interval + 1:
+        return f"{fsyncs} fsyncs in {elapsed:.2f} seconds, more than one every {interval} seconds"
+
+    if policy == 'rollover' and fsyncs > 0:
+        return f"{fsyncs} fsyncs before the session was closed"
+
+    return None
+
+
+def run_child(args):
+    fsyncs = 0
+    real_fsync = os.fsync
+
+    def counting_fsync(fd):
+        nonlocal fsyncs
+        fsyncs += 1
+        real_fsync(fd)
+
+    def counting_sync(method):
+        def wrapper(self):
+            nonlocal fsyncs
+            fsyncs += 1
+            method(self)
+        return wrapper
+
+    os.fsync = counting_fsync
+    SessionDatabase._sync = counting_sync(SessionDatabase._sync)
+    SessionDatabase._close = counting_sync(SessionDatabase._close)
+
+    async def write():
+        if args.stores[0] == 'sqlite':
+            db = SessionDatabase(args.path, durability=args.policies[0],
+                                 group_commit_interval=args.group_commit_ms / 1000)
+            jnl = db.create(SESSION_DATE)
+        else:
+            jnl = journal.SessionJournal(args.path, durability=args.policies[0],
+                                         group_commit_interval=args.group_commit_ms / 1000)
+        start = time.monotonic()
+        for i in range(args.messages):
+            jnl.append([UserMessage(f"Message {i}")])
+            await jnl.wait_written()
+            print(json.dumps({"acked": i + 1, "fsyncs": fsyncs, "elapsed": time.monotonic() - start}), flush=True)
+            await asyncio.sleep(args.delay / 1000)
+
+        if args.close:
+            await jnl.close()
+            print(json.dumps({"closed": True, "fsyncs": fsyncs}), flush=True)
+        else:
+            # Wait to be killed
+            await asyncio.sleep(3600)
+
+    asyncio.run(write())
+
+
+def read_back(store, path):
+    """Returns the messages that were written to the session at path."""
+
+    if not path.is_file():
+        return []
+
+    if store == 'sqlite':
+        result = SessionDatabase(path).load(SESSION_DATE)
+        return result[0] if result else []
+
+    with path.open('r') as fh:
+        messages, records = journal.replay(fh)
+    return messages
+
+
+def check(store, policy, args, close):
+    """Runs a child writing to the given store with the given policy.
+    Returns the number of messages it acknowledged, the number recovered, its
+    fsync count and the number of seconds it took."""
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir) / ('session.sqlite' if store == 'sqlite' else 'session.jsonl')
+        command = [sys.executable, __file__, '--child', str(path), '--messages', str(args.messages),
+                   '--delay', str(args.delay), '--group-commit-ms', str(args.group_commit_ms),
+                   '--store', store, policy]
+        if close:
+            command.append('--close')
+
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+        acked = 0
+        fsyncs = 0
+        elapsed = 0.0
+        for line in proc.stdout:
+            status = json.loads(line)
+            fsyncs = status["fsyncs"]
+            elapsed = status.get("elapsed", elapsed)
+            if status.get("closed") or status.get("acked", 0) == args.messages:
+                acked = args.messages
+                if not close:
+                    break
+            else:
+                acked = status["acked"]
+
+        if close:
+            if proc.wait() != 0:
+                raise RuntimeError(f"Writing to {store} with policy {policy} failed")
+        else:
+            proc.send_signal(signal.SIGKILL)
+            proc.wait()
+
+        messages = read_back(store, path)
+        expected = [f"Message {i}" for i in range(len(messages))]
+        if [message.content for message in messages] != expected:
+            raise RuntimeError(f"Session written to {store} with policy {policy} does not read back in order")
+
+        return acked, len(messages), fsyncs, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks what the session durability policies survive.")
+    parser.add_argument("policies", nargs='*', default=list(journal.DURABILITY_POLICIES), help="policies to check")
+    parser.add_argument("--store", choices=STORES, action='append', dest='stores',
+                        help="session store to check, may be repeated (default: all)")
+    parser.add_argument("--messages", type=int, default=100, help="number of messages to append")
+    parser.add_argument("--delay", type=float, default=2, help="milliseconds between messages")
+    parser.add_argument("--group-commit-ms", type=float, default=journal.GROUP_COMMIT_INTERVAL * 1000,
+                        help="interval between group commits")
+    parser.add_argument("--child", metavar="PATH", dest="path", help=argparse.SUPPRESS)
+    parser.add_argument("--close", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.path:
+        run_child(args)
+        return
+
+    failed = False
+    for store in args.stores or STORES:
+        for policy in args.policies:
+            # Every policy hands acknowledged messages to the OS, so none of
+            # them may be lost when the process is killed
+            acked, recovered, fsyncs, elapsed = check(store, policy, args, close=False)
+            print(f"{store} {policy}: killed after {acked} messages, {recovered} recovered, {fsyncs} fsyncs")
+            if recovered < acked:
+                print(f"  Killing the process lost {acked - recovered} acknowledged messages")
+                failed = True
+
+            problem = check_fsyncs(policy, acked, fsyncs, elapsed, args.group_commit_ms / 1000)
+            if problem:
+                print(f"  {problem}")
+                failed = True
+
+            acked, recovered, fsyncs, elapsed = check(store, policy, args, close=True)
+            print(f"{store} {policy}: closed after {acked} messages, {recovered} recovered, {fsyncs} fsyncs")
+            if recovered != acked:
+                print(f"  Closing the session lost {acked - recovered} messages")
+                failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
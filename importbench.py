@@ -0,0 +1,88 @@
+"""Measures how long it takes to import the modules of the bot in a fresh
+interpreter, and lists the slowest imports and the provider SDKs that were
+pulled in along the way.  Run it before and after changing imports:
+
+    python importbench.py
+    python importbench.py --repeat 10 lib.models
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+DEFAULT_TARGETS = ['lib.models', 'lib.assistant', 'lib.bot', 'main']
+
+# Provider SDKs that should only be imported when a model needs them
+SDK_MODULES = ['anthropic', 'openai', 'google.generativeai']
+
+
+def import_once(target):
+    """Imports the target in a new interpreter.  Returns the wall time in
+    seconds and the per-module timings reported by -X importtime, as a
+    dict of module name -> (cumulative microseconds, nesting depth)."""
+
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {target}'],
+                          capture_output=True, text=True)
+    duration = time.perf_counter() - start
+
+    if proc.returncode != 0:
+        raise RuntimeError(f"Importing {target} failed:\n{proc.stderr}")
+
+    timings = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+
+        # Nested imports are indented further
+        name = fields[2].rstrip()
+        depth = len(name) - len(name.lstrip())
+        timings[name.strip()] = (int(fields[1]), depth)
+
+    return duration, timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the time taken to import the bot's modules.")
+    parser.add_argument("targets", nargs='*', default=DEFAULT_TARGETS, help="modules to import")
+    parser.add_argument("--repeat", type=int, default=5, help="number of times to import each module")
+    parser.add_argument("--top", type=int, default=5, help="number of slowest imports to list")
+    args = parser.parse_args()
+
+    # Imports done by the interpreter itself at startup
+    baseline_runs = [import_once('sys') for i in range(args.repeat)]
+    baseline = statistics.median(duration for duration, timings in baseline_runs)
+    startup_modules = set(baseline_runs[0][1])
+    print(f"Interpreter startup: {baseline * 1000:.0f} ms")
+
+    for target in args.targets:
+        durations = []
+        for i in range(args.repeat):
+            duration, timings = import_once(target)
+            durations.append(duration)
+
+        print(f"\n{target}: {(statistics.median(durations) - baseline) * 1000:.0f} ms (median of {args.repeat})")
+
+        # Only list modules imported at the top level of the dependency tree,
+        # since their time includes that of their own imports
+        timings = {name: timing for name, timing in timings.items() if name not in startup_modules}
+        min_depth = min((depth for us, depth in timings.values()), default=0)
+        top_level = [(us, name) for name, (us, depth) in timings.items() if depth == min_depth]
+        for us, name in sorted(top_level, reverse=True)[:args.top]:
+            print(f"  {us / 1000:7.1f} ms  {name}")
+
+        sdks = [sdk for sdk in SDK_MODULES if sdk in timings]
+        if sdks:
+            print(f"  Provider SDKs imported: {', '.join(sdks)}")
+        else:
+            print("  No provider SDKs imported")
+
+
+if __name__ == '__main__':
+    main()
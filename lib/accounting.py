@@ -0,0 +1,225 @@
+"""Records the token usage and latency of every model call in a local SQLite
+database, tagged with the part of the bot that made the call, so that it can
+be seen what drives the costs and the slow turns.  The rows are written by a
+background thread, so that the event loop doesn't wait for the disk."""
+
+import atexit
+import os
+import pathlib
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+USAGE_DB_PATH = pathlib.Path(__file__).parent.parent.resolve() / 'usage.sqlite'
+
+# What the current model calls are being made for, eg. 'chat' or 'diary'
+current_caller = ContextVar('current_caller', default=None)
+
+# The CallRecord of the model call in progress, which is filled in by the
+# model implementations as they learn about the usage
+current_call = ContextVar('current_call', default=None)
+
+
+@contextmanager
+def caller(name):
+    """Tags the model calls made within this context with the given name.
+    Does nothing if name is None."""
+
+    if name is None:
+        yield
+        return
+
+    token = current_caller.set(name)
+    try:
+        yield
+    finally:
+        current_caller.reset(token)
+
+
+class CallRecord:
+    """The usage of a single model call, including any retries."""
+
+    def __init__(self, caller, provider, model, batched=False):
+        self.time = time.time()
+        self.caller = caller or 'unknown'
+        self.provider = provider
+        self.model = model
+        self.batched = batched
+        self.input_tokens = 0
+        self.cached_tokens = 0
+        self.cache_write_tokens = 0
+        self.output_tokens = 0
+        self.latency = 0.0
+        self.wait = 0.0
+        self.attempts = 0
+        self.success = False
+
+    def add_usage(self, read_tokens=0, written_tokens=0, uncached_tokens=0, output_tokens=0):
+        self.input_tokens += read_tokens + written_tokens + uncached_tokens
+        self.cached_tokens += read_tokens
+        self.cache_write_tokens += written_tokens
+        self.output_tokens += output_tokens
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+class UsageLog:
+    """The database of model calls.  Recorded calls are queued for a writer
+    thread, which commits everything that has built up in one go."""
+
+    def __init__(self, path=USAGE_DB_PATH):
+        # Shared with the writer thread, which holds the lock while using it
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.thread_lock = threading.Lock()
+
+        self.db.execute("""CREATE TABLE IF NOT EXISTS calls (
+            time REAL, caller TEXT, provider TEXT, model TEXT, batched INTEGER,
+            input_tokens INTEGER, cached_tokens INTEGER, cache_write_tokens INTEGER,
+            output_tokens INTEGER, latency REAL, wait REAL, attempts INTEGER,
+            success INTEGER)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS calls_time ON calls (time)")
+        self.db.commit()
+
+    def record(self, call):
+        """Queues the given CallRecord to be written."""
+
+        self.submit((
+            call.time, call.caller, call.provider, call.model, int(call.batched),
+            call.input_tokens, call.cached_tokens, call.cache_write_tokens,
+            call.output_tokens, call.latency, call.wait, call.attempts,
+            int(call.success)))
+
+    def submit(self, item):
+        with self.thread_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='usage-writer', daemon=True)
+                self.thread.start()
+                atexit.register(self.stop)
+
+        self.queue.put(item)
+
+    def wait_written(self):
+        """Blocks until the calls recorded so far have been written."""
+
+        if self.thread is not None:
+            written = threading.Event()
+            self.submit(written)
+            written.wait()
+
+    def stop(self):
+        """Writes out the calls recorded so far and stops the thread."""
+
+        with self.thread_lock:
+            thread = self.thread
+            self.thread = None
+
+        if thread is not None:
+            self.queue.put(None)
+            thread.join()
+
+    def run(self):
+        while True:
+            # Take everything that has built up, so it's committed together
+            items = [self.queue.get()]
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            rows = [item for item in items if isinstance(item, tuple)]
+            if rows:
+                try:
+                    with self.lock:
+                        self.db.executemany("INSERT INTO calls VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                        self.db.commit()
+                except sqlite3.Error as ex:
+                    print(f"Failed to record model usage: {ex}")
+
+            for item in items:
+                if isinstance(item, threading.Event):
+                    item.set()
+
+            if None in items:
+                return
+
+    def summarise(self, since=None, group_by='caller'):
+        """Returns a list of dicts summarising the calls made since the given
+        UNIX time, grouped by 'caller', 'model' or 'provider'."""
+
+        assert group_by in ('caller', 'model', 'provider')
+
+        self.wait_written()
+        with self.lock:
+            rows = self.db.execute(f"SELECT {group_by}, batched, input_tokens, cached_tokens, output_tokens, latency, wait, attempts, success FROM calls WHERE time >= ?", (since or 0, )).fetchall()
+
+        groups = {}
+        for key, batched, input_tokens, cached_tokens, output_tokens, latency, wait, attempts, success in rows:
+            group = groups.get(key)
+            if group is None:
+                group = {'name': key, 'calls': 0, 'input_tokens': 0, 'cached_tokens': 0, 'output_tokens': 0, 'retries': 0, 'failures': 0, 'wait': 0.0, 'latencies': []}
+                groups[key] = group
+
+            group['calls'] += 1
+            group['input_tokens'] += input_tokens
+            group['cached_tokens'] += cached_tokens
+            group['output_tokens'] += output_tokens
+            group['retries'] += max(attempts - 1, 0)
+            group['failures'] += 0 if success else 1
+            group['wait'] += wait
+
+            # Batched calls take hours, which says nothing about responsiveness
+            if not batched:
+                group['latencies'].append(latency)
+
+        return sorted(groups.values(), key=lambda group: -group['input_tokens'])
+
+
+def format_summary(groups):
+    """Formats the result of UsageLog.summarise as lines of text."""
+
+    lines = []
+    for group in groups:
+        line = f"{group['name']}: {group['calls']} calls, {group['input_tokens']} input tokens ({group['cached_tokens']} cached), {group['output_tokens']} output tokens"
+        latencies = group['latencies']
+        if latencies:
+            line += f", latency p50 {percentile(latencies, 0.5):.1f}s p90 {percentile(latencies, 0.9):.1f}s"
+        if group['wait'] >= 0.1:
+            line += f", {group['wait']:.1f}s waiting for rate limits"
+        if group['retries']:
+            line += f", {group['retries']} retries"
+        if group['failures']:
+            line += f", {group['failures']} failed"
+        lines.append(line)
+    return lines
+
+
+# Opened on first use
+usage_log = None
+
+
+def get_usage_log():
+    global usage_log
+    if usage_log is None:
+        usage_log = UsageLog(os.environ.get('USAGE_DB_PATH') or USAGE_DB_PATH)
+    return usage_log
+
+
+def record(call):
+    """Stores the given CallRecord in the background.  Failures to do so are
+    not fatal."""
+
+    try:
+        get_usage_log().record(call)
+    except sqlite3.Error as ex:
+        print(f"Failed to record model usage: {ex}")
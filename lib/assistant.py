@@ -2,14 +2,18 @@ import pathlib
 import json
 import sys, os
 import asyncio
+import sqlite3
 from collections import defaultdict
 from datetime import datetime, time, timezone, timedelta
 from zoneinfo import ZoneInfo
 
-from . import models
+from . import models, journal
 from .session import Session
-from .msgtypes import parse_message
 from .plugin import Plugin
+from .batches import BatchJob
+from .cache import ResponseCache, RESPONSE_CACHE_MAX_ENTRIES
+from .store import SessionDatabase
+from .manifest import SessionManifest
 
 if sys.version_info >= (3, 11):
     import tomllib
@@ -18,6 +22,7 @@ else:
 
 SESSION_DIR = pathlib.Path(__file__).parent.parent.resolve() / 'sessions'
 MEMORY_DIR = pathlib.Path(__file__).parent.parent.resolve() / 'memory'
+CACHE_DIR = pathlib.Path(__file__).parent.parent.resolve() / 'cache'
 
 
 class Assistant:
@@ -30,11 +35,25 @@ class Assistant:
         self.discord_config = {}
         self.plugin_config = {}
         self.summarisation_threshold = None
+        self.summarisation_token_threshold = None
         self.unsummarised_messages = 1000
+        self.context_token_budget = None
+        self.full_context_messages = 5
         self.timezone = None
         self.rollover = None
         self.response_delay = 1
         self.default_prompt_after = 30
+        self.stream_responses = True
+        self.response_cache = None
+
+        # 'jsonl' for a journal file per session, or 'sqlite' for a database
+        self.session_store = 'jsonl'
+        self.session_db = None
+        self.manifest = None
+
+        # When changes to sessions are fsynced, see lib/journal.py
+        self.session_durability = journal.DEFAULT_DURABILITY
+        self.session_group_commit_ms = journal.GROUP_COMMIT_INTERVAL * 1000
 
         self.plugins = {}
         self.__hooks = defaultdict(list)
@@ -62,6 +81,9 @@ class Assistant:
         ident = data.get('id', ident)
 
         model_name = data['model']
+        if isinstance(model_name, list):
+            # Multiple models are combined, trying them in order
+            model_name = '|'.join(model_name)
         model = models.create(model_name)
 
         ass = Assistant(ident, model)
@@ -78,12 +100,31 @@ class Assistant:
         ass.prompt_template = data['system_prompt']
         ass.discord_config = data.get('discord', {})
         ass.summarisation_threshold = data.get('summarisation_threshold')
+        ass.summarisation_token_threshold = data.get('summarisation_token_threshold')
         ass.unsummarised_messages = data.get('unsummarised_messages', 1000)
+        ass.context_token_budget = data.get('context_token_budget')
+        ass.full_context_messages = data.get('full_context_messages', 5)
         ass.response_delay = data.get('response_delay', 1)
+        ass.stream_responses = data.get('stream_responses', True)
         ass.default_prompt_after = data.get('default_prompt_after', 30)
         if ass.default_prompt_after <= 0:
             ass.default_prompt_after = None
         ass.plugin_config = data.get('plugins', {})
+
+        ass.session_store = data.get('session_store', 'jsonl')
+        if ass.session_store not in ('jsonl', 'sqlite'):
+            raise ValueError(f"session_store should be 'jsonl' or 'sqlite', not {ass.session_store!r}")
+
+        ass.session_durability = data.get('session_durability', journal.DEFAULT_DURABILITY)
+        if ass.session_durability not in journal.DURABILITY_POLICIES:
+            raise ValueError(f"session_durability should be one of {', '.join(journal.DURABILITY_POLICIES)}, not {ass.session_durability!r}")
+        ass.session_group_commit_ms = data.get('session_group_commit_ms', journal.GROUP_COMMIT_INTERVAL * 1000)
+
+        # Caching of isolated query responses is opt-in
+        if data.get('response_cache_ttl'):
+            path = CACHE_DIR / f'{ass.id}-responses.sqlite'
+            max_entries = data.get('response_cache_max_entries', RESPONSE_CACHE_MAX_ENTRIES)
+            ass.response_cache = ResponseCache(path, data['response_cache_ttl'], max_entries)
         return ass
 
     async def load_plugins(self):
@@ -111,6 +152,23 @@ class Assistant:
 
         return plugin
 
+    def resume_batch_jobs(self):
+        """Resumes any batch jobs that were interrupted by a restart.  Returns
+        the tasks running them."""
+
+        tasks = []
+        for job in BatchJob.load_pending(self.id):
+            plugin = self.plugins.get(job.plugin)
+            continuation = getattr(plugin, job.continuation, None)
+            if not getattr(continuation, '_batch_continuation', False):
+                print(f"Not resuming batch job {job.key}, plugin {job.plugin} is not loaded")
+                continue
+
+            print(f"Resuming batch job {job.key}")
+            tasks.append(plugin.schedule(None, plugin.run_batch_job(continuation, *job.args)))
+
+        return tasks
+
     def call_hooks(self, name, *args, **kwargs):
         for hooks in self.__hooks[name]:
             for hook in hooks:
@@ -140,13 +198,17 @@ class Assistant:
 
     async def make_system_prompt(self, date, last_session=None):
         prompt = []
-        if last_session is None:
-            last_session = self.find_session_before(date)
+
+        # The last session itself is only loaded if a question needs it
+        if last_session is not None:
+            last_date = last_session.date
+        else:
+            last_date = self.find_session_date_before(date)
 
         # Let the AI know what day it is relative to the day it's based on
         date_str = date.strftime('%A, %d %B %Y')
-        if last_session:
-            delta = date - last_session.date
+        if last_date:
+            delta = date - last_date
             if delta.days == 1:
                 preface = f"It is now {date_str} (the next day)."
             elif delta.days > 1:
@@ -174,8 +236,10 @@ class Assistant:
 
             elif component['type'] == 'question':
                 question = component['question'].strip()
+                if last_session is None and last_date:
+                    last_session = self.load_existing_session(last_date)
                 if last_session:
-                    response = await last_session.isolated_query(f'SYSTEM: {preface} {question}')
+                    response = await last_session.isolated_query(f'SYSTEM: {preface} {question}', caller='system_prompt_question')
                     prompt.append(response.strip())
 
             elif component['type'] == 'user_profile':
@@ -188,33 +252,100 @@ class Assistant:
 
         return '\n\n'.join(prompt)
 
+    def find_session_date_before(self, date, limit=100):
+        """Returns the date of the last session occurring before (not on) the
+        given date, and no more than limit days before it."""
+
+        return self.get_manifest().find_before(self.id, date, date - timedelta(days=limit))
+
     def find_session_before(self, date, limit=100):
         """Finds the last session occurring before (not on) the given date."""
 
-        for i in range(limit):
-            date = date - timedelta(days=1)
+        last_date = self.find_session_date_before(date, limit)
+        if last_date is None:
+            return None
+
+        return self.load_existing_session(last_date)
 
+    def get_manifest(self):
+        if self.manifest is None:
+            SESSION_DIR.mkdir(exist_ok=True)
+            self.manifest = SessionManifest(SESSION_DIR / 'manifest.sqlite')
+            if not self.manifest.has_sessions(self.id):
+                self.rebuild_manifest()
+        return self.manifest
+
+    def rebuild_manifest(self):
+        """Adds the sessions that exist on disk to the manifest.  Whether
+        there are diary entries or memory updates for them is left unknown."""
+
+        dates = set()
+        for path in SESSION_DIR.glob(f'{self.id}-????-??-??.jsonl'):
+            dates.add(datetime.strptime(path.stem[-10:], '%Y-%m-%d').date())
+        if self.session_store == 'sqlite':
+            dates.update(self.get_session_db().session_dates())
+
+        for date in sorted(dates):
             session = self.load_existing_session(date)
             if session is not None:
-                return session
-
-        return None
+                self.record_session(session)
+
+    def record_session(self, session, **fields):
+        """Updates the manifest entry of the given session with its current
+        state and any given fields.  Failures to do so are not fatal."""
+
+        try:
+            self.get_manifest().update(self.id, session.date,
+                                       messages=len(session.message_history),
+                                       last_activity=session.last_activity.timestamp(),
+                                       summary=session.has_summary,
+                                       **fields)
+        except sqlite3.Error as ex:
+            print(f"Failed to update session manifest: {ex}")
+
+    def get_session_db(self):
+        if self.session_db is None:
+            SESSION_DIR.mkdir(exist_ok=True)
+            self.session_db = SessionDatabase(SESSION_DIR / f'{self.id}.sqlite', self.session_durability,
+                                              self.session_group_commit_ms / 1000)
+        return self.session_db
+
+    def make_session_journal(self, session_path, records=0):
+        return journal.SessionJournal(session_path, records, self.session_durability,
+                                      self.session_group_commit_ms / 1000)
 
     def load_existing_session(self, date, writable=False):
         session_path = SESSION_DIR / f'{self.id}-{date.isoformat()}.jsonl'
 
+        if self.session_store == 'sqlite':
+            db = self.get_session_db()
+            if not db.has_session(date):
+                if not session_path.is_file():
+                    return None
+
+                # Carry over sessions from before the database was used
+                print(f"Importing {session_path} into session database")
+                db.import_jsonl(date, session_path)
+
+            messages, store, modified = db.load(date)
+            session = Session(date, self)
+            session.last_activity = modified
+            session.set_message_history(messages)
+            if writable:
+                session.journal = store
+
+            return session
+
         if session_path.is_file():
-            session_file = session_path.open('r+' if writable else 'r')
             session = Session(date, self)
             session.last_activity = datetime.fromtimestamp(session_path.stat().st_mtime, tz=timezone.utc)
 
-            if writable:
-                session.messages_file = session_file
+            with session_path.open('r') as fh:
+                messages, records = journal.replay(fh)
+                session.set_message_history(messages)
 
-            for line in session_file:
-                line = line.strip()
-                if line:
-                    session.message_history.append(parse_message(line))
+            if writable:
+                session.journal = self.make_session_journal(session_path, records)
 
             return session
         else:
@@ -228,12 +359,14 @@ class Assistant:
         system_prompt = await self.make_system_prompt(date, last_session=last_session)
         session = Session(date, self, system_prompt)
 
-        session_path = SESSION_DIR / f'{self.id}-{date.isoformat()}.jsonl'
-        session_path.parent.mkdir(exist_ok=True)
-
-        session_file = session_path.open('w')
-        session.system_message.dump(session_file)
-        session_file.flush()
+        if self.session_store == 'sqlite':
+            session.journal = self.get_session_db().create(date)
+        else:
+            session_path = SESSION_DIR / f'{self.id}-{date.isoformat()}.jsonl'
+            session_path.parent.mkdir(exist_ok=True)
+            session.journal = self.make_session_journal(session_path)
 
-        session.messages_file = session_file
+        session.journal.append([session.system_message])
+        session.journal.flush()
+        self.record_session(session)
         return session
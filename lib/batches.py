@@ -0,0 +1,126 @@
+"""Keeps track of batch jobs that have been submitted to a model provider, so
+that they can be picked up again if the bot is restarted before they finish."""
+
+import hashlib
+import json
+import os
+import pathlib
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+BATCHES_DIR = pathlib.Path(__file__).parent.parent.resolve() / 'batches'
+
+# The batch job that is currently running, if any
+current_job = ContextVar('current_job', default=None)
+
+
+def request_digest(params):
+    """Returns a digest of the parameters of a batched request, to tell
+    whether a resumed job is making the same request as before."""
+
+    data = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class BatchJob:
+    """A piece of work that submits one or more batches.  It is resumed by
+    calling the same continuation on the same plugin with the same arguments,
+    which is expected to make the same batch queries in the same order.  The
+    batches that were already submitted are then reused instead of being
+    submitted again, as long as their requests are unchanged."""
+
+    def __init__(self, key, assistant_id, plugin, continuation, args, batches=None):
+        self.key = key
+        self.assistant_id = assistant_id
+        self.plugin = plugin
+        self.continuation = continuation
+        self.args = list(args)
+        self.batches = batches or []
+        self.next_index = 0
+
+    @property
+    def path(self):
+        return BATCHES_DIR / f'{self.key}.json'
+
+    @staticmethod
+    def load(key):
+        """Returns the job with the given key if it was recorded, else None."""
+
+        path = BATCHES_DIR / f'{key}.json'
+        if not path.is_file():
+            return None
+
+        with path.open('r') as fh:
+            data = json.load(fh)
+
+        return BatchJob(key, data['assistant'], data['plugin'], data['continuation'], data['args'], data['batches'])
+
+    @staticmethod
+    def load_pending(assistant_id):
+        """Returns all recorded jobs for the given assistant."""
+
+        if not BATCHES_DIR.is_dir():
+            return []
+
+        jobs = []
+        for path in sorted(BATCHES_DIR.glob('*.json')):
+            job = BatchJob.load(path.stem)
+            if job is not None and job.assistant_id == assistant_id:
+                jobs.append(job)
+        return jobs
+
+    def save(self):
+        data = {
+            "assistant": self.assistant_id,
+            "plugin": self.plugin,
+            "continuation": self.continuation,
+            "args": self.args,
+            "batches": self.batches,
+        }
+
+        # Write to a temporary file first so that a crash can't leave a
+        # truncated record behind
+        BATCHES_DIR.mkdir(exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with tmp_path.open('w') as fh:
+            json.dump(data, fh, indent=4)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if self.path.is_file():
+            self.path.unlink()
+
+    def claim_batch(self, model_name, custom_ids, digests):
+        """Returns the id of a batch that was submitted by an earlier run of
+        this job for the same requests, or None if a new batch needs to be
+        submitted.  The requests are compared through the digests of their
+        parameters, since a continuation may pick different inputs when it is
+        run again."""
+
+        index = self.next_index
+        self.next_index += 1
+
+        if index < len(self.batches):
+            record = self.batches[index]
+            if (record['model'] == model_name and record['custom_ids'] == custom_ids
+                    and record.get('digests') == digests):
+                return record['id']
+
+            # The job took a different path this time, so the rest of the
+            # recorded batches are of no use any more
+            del self.batches[index:]
+            self.save()
+
+        return None
+
+    def record_batch(self, batch_id, model_name, custom_ids, digests):
+        """Records that a batch has been submitted for this job."""
+
+        self.batches.append({
+            "id": batch_id,
+            "model": model_name,
+            "custom_ids": custom_ids,
+            "digests": digests,
+            "submitted": datetime.now(tz=timezone.utc).isoformat(),
+        })
+        self.save()
@@ -11,12 +11,17 @@ from collections import defaultdict
 from functools import wraps
 
 from .util import split_message, format_json_md, translate_cites
+from .jsonrepair import extract_partial_string
 from .msgtypes import UserMessage, Attachment, Channel, Role
 from . import views
+from . import models, ratelimit, accounting
 
 # Max chars Discord allows to be sent per message
 MESSAGE_LIMIT = 2000
 
+# Minimum time in seconds between edits of a message being streamed
+STREAM_EDIT_INTERVAL = 1.0
+
 
 class Retry(discord.ui.View):
     def __init__(self):
@@ -33,6 +38,85 @@ class Retry(discord.ui.View):
         self.stop()
 
 
+class StreamingMessage:
+    """Shows the chat text of a response that is still being generated in a
+    placeholder message, which is edited as more text comes in, but no more
+    often than once every STREAM_EDIT_INTERVAL seconds."""
+
+    def __init__(self, channel, interval=STREAM_EDIT_INTERVAL):
+        self.channel = channel
+        self.interval = interval
+        self.message = None
+        self.text = ''
+
+        self.__task = None
+        self.__last_edit = 0.0
+        self.__finished = asyncio.Event()
+
+    def update(self, raw_text):
+        """Called with the raw response text received so far."""
+
+        chat = extract_partial_string(raw_text, 'chat')
+        if not chat or chat == self.text or self.__finished.is_set():
+            return
+
+        self.text = chat
+        if self.__task is None:
+            self.__task = asyncio.create_task(self.__run())
+
+    async def __run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while not self.__finished.is_set():
+                # Respect the rate limit if we were woken up again early
+                delay = self.__last_edit + self.interval - loop.time()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(self.__finished.wait(), delay)
+                        break
+                    except asyncio.TimeoutError:
+                        pass
+
+                text = self.text
+                content = translate_cites(text)[:MESSAGE_LIMIT]
+                if self.message is None:
+                    self.message = await self.channel.send(content)
+                else:
+                    await self.message.edit(content=content)
+                self.__last_edit = loop.time()
+
+                if self.text == text:
+                    break
+
+        except discord.HTTPException as ex:
+            print(f"Failed to update streamed message: {ex}")
+            self.__finished.set()
+
+        finally:
+            self.__task = None
+
+    async def finish(self):
+        """Stops updating the message and returns the placeholder message, if
+        one has been posted."""
+
+        self.__finished.set()
+        task = self.__task
+        if task is not None:
+            await task
+        return self.message
+
+    async def discard(self):
+        """Stops updating and deletes the placeholder message, if any."""
+
+        message = await self.finish()
+        self.message = None
+        if message is not None:
+            try:
+                await message.delete()
+            except discord.HTTPException:
+                pass
+
+
 class Bot(discord.Client):
     def __init__(self, assistant, session_date):
         self.assistant = assistant
@@ -226,10 +310,17 @@ class Bot(discord.Client):
             await self.__ready
 
         while True:
+            stream = None
+            if self.chat_channel and self.assistant.stream_responses:
+                stream = StreamingMessage(self.chat_channel)
+
             try:
-                responses = await self.session.query_assistant_response()
+                responses = await self.session.query_assistant_response(on_partial=stream.update if stream else None)
                 break
-            except ValueError as ex:
+            except (ValueError, models.ModelError) as ex:
+                if stream is not None:
+                    await stream.discard()
+
                 channel = self.chat_channel or self.log_channel
                 if channel is None:
                     raise
@@ -242,11 +333,27 @@ class Bot(discord.Client):
                     pass
                 if not view.retry:
                     return
+            except:
+                if stream is not None:
+                    await stream.discard()
+                raise
+
+        placeholder = await stream.finish() if stream else None
+
+        for response in responses or ():
+            await self._process_response(response, placeholder)
+
+            # Only the first response takes over the streamed message
+            placeholder = None
 
-        for response in responses:
-            await self._process_response(response)
+        if placeholder is not None:
+            await stream.discard()
+
+    async def _process_response(self, response, placeholder=None):
+        """Sends out the given response.  If placeholder is given, it is a
+        message containing a streamed preview of the response, which will
+        be replaced with the final chat message."""
 
-    async def _process_response(self, response):
         # Find the corresponding user messages.
         messages = []
         for user_message in response.user_messages:
@@ -314,9 +421,16 @@ class Bot(discord.Client):
             if response.actions_taken:
                 chat = '\n-# '.join([chat or ''] + response.actions_taken)
 
-            if chat or files:
+            if placeholder is not None and chat and not files and len(chat) <= MESSAGE_LIMIT:
+                tasks.insert(0, placeholder.edit(content=chat))
+                placeholder = None
+
+            elif chat or files:
                 tasks.insert(0, self.send_message(self.chat_channel, chat, files=files, silent=silent))
 
+        if placeholder is not None:
+            tasks.append(placeholder.delete())
+
         # Check exceptions and report them.  This includes any exceptions from
         # the action tasks, which were ignored earlier.
         gatherer = asyncio.gather(*tasks, return_exceptions=True)
@@ -413,7 +527,8 @@ class Bot(discord.Client):
     async def on_ready(self):
         print(f'{self.user} has connected to Discord!')
 
-        if not self.__ready.done():
+        first_ready = not self.__ready.done()
+        if first_ready:
             self.__ready.set_result(None)
 
         # Reset these if necessary
@@ -437,6 +552,11 @@ class Bot(discord.Client):
         # Run the on_ready hooks
         await asyncio.gather(*self.assistant.call_hooks('discord_ready', self))
 
+        # Pick up any batch jobs that were interrupted by a restart; they
+        # run in the background as they may take a long time to complete
+        if first_ready:
+            self.assistant.resume_batch_jobs()
+
         # Do this in the background, it takes a long time
         if self.chat_channel:
             guild = self.chat_channel.guild
@@ -491,11 +611,8 @@ class Bot(discord.Client):
             return
 
         # Get the last user message with a Discord id
-        for message in self.session.message_history[::-1]:
-            if message.id:
-                last_user_msg = message
-                break
-        else:
+        last_user_msg = self.session.last_message_with_id
+        if not last_user_msg:
             return
 
         try:
@@ -540,10 +657,10 @@ class Bot(discord.Client):
                 attachments = [Attachment(attach.url, attach.content_type) for attach in message.attachments]
 
                 try:
-                    reply = await self.session.isolated_query(message.content, attachments=attachments)
+                    reply = await self.session.isolated_query(message.content, attachments=attachments, caller='query_channel')
                     if reply.startswith('{'):
                         reply = f'```json\n{reply}\n```'
-                except ValueError as ex:
+                except (ValueError, models.ModelError) as ex:
                     reply = f'⚠️ **Error**: {ex}'
 
             await self.send_message(self.query_channel, reply)
@@ -561,7 +678,7 @@ class Bot(discord.Client):
             attach_ids = set(int(attach["id"]) for attach in payload.data["attachments"])
             message.attachments = [attachment for attachment in message.attachments if attachment.id in attach_ids]
 
-        self.session._rewrite_message_file()
+        self.session.update_message(message)
 
     async def on_raw_message_delete(self, payload):
         self.session.delete_message(payload.message_id)
@@ -590,6 +707,9 @@ class Bot(discord.Client):
 
             self.session = await self.assistant.load_session(date, old_session)
 
+            # Make sure the old session is on disk before it's wrapped up
+            await old_session.close()
+
             if self.log_channel:
                 futures.append(self.send_message(self.log_channel, self.session.initial_system_prompt))
 
@@ -631,6 +751,35 @@ class Bot(discord.Client):
             modal = views.EditSystemPromptModal(self.session)
             await interaction.response.send_modal(modal)
 
+        @self.tree.command(name="context_report", description="Show which part of the conversation was sent with the last query")
+        async def context_report(interaction: discord.Interaction):
+            report = self.session.context_report
+            text = f'Last query: {report}' if report else 'No query has been made yet this session.'
+            await interaction.response.send_message(text, ephemeral=True)
+
+        @self.tree.command(name="prompt_cache_stats", description="Show how well the model providers' prompt caches are being used")
+        async def prompt_cache_stats(interaction: discord.Interaction):
+            lines = [f'- **{model_name}**: {stats}' for model_name, stats in models.prompt_cache_stats.items()]
+            text = '\n'.join(lines) or 'No model queries have been made yet.'
+            await interaction.response.send_message(text, ephemeral=True)
+
+        @self.tree.command(name="system_prompt_stats", description="Show how often the system prompt could be reused without asking the plugins again")
+        async def system_prompt_stats(interaction: discord.Interaction):
+            await interaction.response.send_message(f'System prompt cache: {self.session.prompt_cache}', ephemeral=True)
+
+        @self.tree.command(name="rate_limit_stats", description="Show how long requests have been waiting for the model providers' rate limits")
+        async def rate_limit_stats(interaction: discord.Interaction):
+            lines = [f'- **{provider}**: {limiter}' for provider, limiter in ratelimit.limiters.items()]
+            text = '\n'.join(lines) or 'No model queries have been made yet.'
+            await interaction.response.send_message(text, ephemeral=True)
+
+        @self.tree.command(name="usage", description="Show the token usage and latency of model calls, by caller")
+        async def usage(interaction: discord.Interaction, days: int = 1):
+            since = (datetime.now(tz=timezone.utc) - timedelta(days=days)).timestamp()
+            lines = accounting.format_summary(accounting.get_usage_log().summarise(since))
+            text = '\n'.join(f'- {line}' for line in lines) or 'No model calls have been made in this period.'
+            await interaction.response.send_message(f'Model usage over the last {days} day(s):\n{text}'[:MESSAGE_LIMIT], ephemeral=True)
+
         self.rollover_lock = asyncio.Lock()
 
         rollover_time = self.assistant.rollover.replace(tzinfo=self.assistant.timezone)
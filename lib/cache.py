@@ -0,0 +1,187 @@
+from collections import OrderedDict
+import hashlib
+import json
+import sqlite3
+import time
+
+# Default maximum total size in bytes of the encoded messages kept per model
+ENCODED_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Default maximum number of responses kept by the response cache
+RESPONSE_CACHE_MAX_ENTRIES = 1000
+
+# Number of cache hits after which their times of use are written to the
+# database, if no response was stored in the meantime
+RESPONSE_CACHE_USED_BATCH = 50
+
+
+def estimate_size(obj):
+    """Roughly estimates the memory used by a JSON-like object, counting the
+    length of the strings it contains."""
+
+    if isinstance(obj, (str, bytes)):
+        return len(obj) + 50
+    elif isinstance(obj, dict):
+        return sum(estimate_size(value) for value in obj.values()) + 100
+    elif isinstance(obj, (list, tuple)):
+        return sum(estimate_size(value) for value in obj) + 50
+    else:
+        return 50
+
+
+class EncodedMessageCache:
+    """Remembers the provider-specific encoding of messages, which can be
+    expensive to produce for messages with image attachments.  Entries are
+    keyed by message identity and are invalidated when the version of the
+    message changes.  The least recently used entries are evicted when the
+    estimated total size exceeds max_bytes."""
+
+    def __init__(self, max_bytes=ENCODED_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        # id(message) -> (message, version, encoded, size)
+        # Holding on to the message guarantees the id won't be reused.
+        self.__entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, message):
+        """Returns the cached encoding of the given message, or None if it
+        has not been encoded yet or has changed since."""
+
+        entry = self.__entries.get(id(message))
+        if entry is None or entry[0] is not message or entry[1] != message.version:
+            self.misses += 1
+            return None
+
+        self.__entries.move_to_end(id(message))
+        self.hits += 1
+        return entry[2]
+
+    def put(self, message, encoded, size=None):
+        """Stores the encoding of the given message.  The encoded object must
+        not be modified afterwards.  If the encoded object is not JSON-like,
+        its size in bytes should be passed in."""
+
+        self.discard(message)
+
+        if size is None:
+            size = estimate_size(encoded)
+        if size > self.max_bytes:
+            return
+
+        self.__entries[id(message)] = (message, message.version, encoded, size)
+        self.size += size
+
+        while self.size > self.max_bytes:
+            _, entry = self.__entries.popitem(last=False)
+            self.size -= entry[3]
+
+    def discard(self, message):
+        entry = self.__entries.pop(id(message), None)
+        if entry is not None:
+            self.size -= entry[3]
+
+    def clear(self):
+        self.__entries.clear()
+        self.size = 0
+
+
+class ResponseCache:
+    """Remembers the responses to queries, keyed by a hash of everything that
+    was sent to the model.  Entries expire after ttl seconds, and the least
+    recently used entries are evicted when there are more than max_entries.
+    If a path is given, the entries are also stored in an SQLite database
+    there, so that they survive a restart."""
+
+    def __init__(self, path=None, ttl=3600.0, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        # key -> (expiry time, response)
+        self.__entries = OrderedDict()
+
+        # key -> time of last use, not yet written to the database.  These
+        # only decide which entries are evicted, so it's no great loss if
+        # the last few are never written.
+        self.__used = {}
+
+        self.__db = None
+        if path is not None:
+            path.parent.mkdir(exist_ok=True)
+            self.__db = sqlite3.connect(path)
+            self.__db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, expires REAL, used REAL, response TEXT)")
+            self.__db.execute("DELETE FROM responses WHERE expires < ?", (time.time(), ))
+            self.__db.commit()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    @staticmethod
+    def make_key(model_name, system_prompt, messages, return_type, temperature):
+        """Returns the cache key for a query with the given parameters."""
+
+        data = [model_name, system_prompt, return_type.__name__, temperature]
+        for message in messages:
+            attachments = [(attach.url, attach.content_type) for attach in message.attachments]
+            data.append((message.role.value, message.content, attachments))
+
+        return hashlib.sha256(json.dumps(data).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Returns the cached response for the given key, or None."""
+
+        now = time.time()
+        entry = self.__entries.get(key)
+        if entry is None and self.__db is not None:
+            row = self.__db.execute("SELECT expires, response FROM responses WHERE key = ?", (key, )).fetchone()
+            if row is not None:
+                entry = (row[0], json.loads(row[1]))
+                self.__entries[key] = entry
+
+        if entry is None or entry[0] < now:
+            if entry is not None:
+                del self.__entries[key]
+                self.__used.pop(key, None)
+            self.misses += 1
+            return None
+
+        self.__entries.move_to_end(key)
+        if self.__db is not None:
+            self.__used[key] = now
+            if len(self.__used) >= RESPONSE_CACHE_USED_BATCH:
+                self.__write_used()
+                self.__db.commit()
+
+        self.hits += 1
+        return entry[1]
+
+    def __write_used(self):
+        self.__db.executemany("UPDATE responses SET used = ? WHERE key = ?", ((used, key) for key, used in self.__used.items()))
+        self.__used.clear()
+
+    def put(self, key, response):
+        """Stores the response for the given key, which must be serializable
+        as JSON."""
+
+        now = time.time()
+        entry = (now + self.ttl, response)
+        self.__entries[key] = entry
+        self.__entries.move_to_end(key)
+
+        while len(self.__entries) > self.max_entries:
+            self.__entries.popitem(last=False)
+
+        if self.__db is not None:
+            self.__used.pop(key, None)
+            self.__write_used()
+            self.__db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, entry[0], now, json.dumps(response)))
+            self.__db.execute("DELETE FROM responses WHERE expires < ?", (now, ))
+            self.__db.execute("DELETE FROM responses WHERE key NOT IN (SELECT key FROM responses ORDER BY used DESC LIMIT ?)", (self.max_entries, ))
+            self.__db.commit()
@@ -0,0 +1,62 @@
+from .msgtypes import Role
+
+
+class ContextReport:
+    """Describes which part of the message history was sent to the model."""
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.full = 0
+        self.reduced = 0
+        self.dropped = 0
+        self.tokens = 0
+
+    def __str__(self):
+        result = f'{self.full} messages in full, {self.reduced} reduced, {self.dropped} dropped, ~{self.tokens} tokens'
+        if self.budget is not None:
+            result += f' of a {self.budget} token budget'
+        return result
+
+
+def plan_context(history, budget=None, full_messages=5, reserved_tokens=0):
+    """Chooses which messages of the history to send to the model, keeping
+    the estimated total under budget tokens, including reserved_tokens taken
+    up by the system prompt and other context.
+
+    The last full_messages messages are always sent as they are.  Older
+    messages are sent in reduced form, newest first, until the budget runs
+    out, after which only summaries that still fit are kept.  The first
+    message (the system message) is always kept.
+
+    Returns the list of messages and a ContextReport."""
+
+    report = ContextReport(budget)
+    report.tokens = reserved_tokens
+
+    if len(history) <= 1:
+        return history[:], report
+
+    split = max(1, len(history) - full_messages)
+    recent = history[split:]
+    for message in recent:
+        report.tokens += message.estimate_tokens()
+    report.full = len(recent)
+
+    older = []
+    exhausted = False
+    for message in reversed(history[1:split]):
+        tokens = message.estimate_tokens(reduced=True)
+
+        if budget is not None and report.tokens + tokens > budget:
+            exhausted = True
+
+        if exhausted and not (message.is_summary() and report.tokens + tokens <= budget):
+            report.dropped += 1
+            continue
+
+        older.append(message.reduce())
+        report.tokens += tokens
+        report.reduced += 1
+
+    older.reverse()
+    return [history[0]] + older + recent, report
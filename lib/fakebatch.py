@@ -0,0 +1,115 @@
+"""A stand-in for the Anthropic message batches endpoint that runs locally,
+for testing batch jobs without access to (or paying for) the real API.
+Enable it by setting $ANTHROPIC_FAKE_BATCHES to a number of seconds that each
+batch should take to complete.
+
+Batches are stored on disk, so they survive a restart of the bot just like
+real ones do."""
+
+import json
+import os
+import pathlib
+import time
+import uuid
+from types import SimpleNamespace
+
+FAKE_BATCHES_DIR = pathlib.Path(__file__).parent.parent.resolve() / 'batches' / 'fake'
+
+FAKE_RESPONSE = "This is a response from the fake batch endpoint."
+
+
+def fake_response(params):
+    """Produces the text of the response to the given request.  If the
+    request is prefilled with the start of a JSON value, the value is closed
+    off so that it parses."""
+
+    messages = params.get("messages") or []
+    if messages and messages[-1]["role"] == "assistant":
+        prefill = messages[-1]["content"]
+        if prefill == '{':
+            return '}'
+        elif prefill == '[':
+            return ']'
+
+    return FAKE_RESPONSE
+
+
+class FakeBatches:
+    """Implements the subset of client.messages.batches used by
+    AnthropicModel."""
+
+    def __init__(self, duration=5.0, responder=fake_response):
+        self.duration = duration
+        self.responder = responder
+
+    def _path(self, batch_id):
+        return FAKE_BATCHES_DIR / f'{batch_id}.json'
+
+    def _load(self, batch_id):
+        with self._path(batch_id).open('r') as fh:
+            return json.load(fh)
+
+    def _save(self, data):
+        FAKE_BATCHES_DIR.mkdir(parents=True, exist_ok=True)
+        with self._path(data['id']).open('w') as fh:
+            json.dump(data, fh)
+
+    def _status(self, data):
+        if data['cancelled']:
+            return 'ended'
+        elif time.time() >= data['created'] + self.duration:
+            return 'ended'
+        else:
+            return 'in_progress'
+
+    def _batch(self, data):
+        return SimpleNamespace(id=data['id'], processing_status=self._status(data))
+
+    async def create(self, requests):
+        data = {
+            "id": "msgbatch_fake_" + uuid.uuid4().hex,
+            "created": time.time(),
+            "cancelled": False,
+            "requests": [{"custom_id": request["custom_id"], "params": request["params"]} for request in requests],
+        }
+        self._save(data)
+        return self._batch(data)
+
+    async def retrieve(self, batch_id):
+        return self._batch(self._load(batch_id))
+
+    async def cancel(self, batch_id):
+        data = self._load(batch_id)
+        if self._status(data) != 'ended':
+            data['cancelled'] = True
+            self._save(data)
+        return self._batch(data)
+
+    async def results(self, batch_id):
+        data = self._load(batch_id)
+        assert self._status(data) == 'ended', "Batch has not yet ended"
+
+        async def iterate():
+            for request in data['requests']:
+                if data['cancelled']:
+                    result = SimpleNamespace(type='canceled', message=None)
+                else:
+                    text = self.responder(request['params'])
+                    block = SimpleNamespace(type='text', text=text)
+                    usage = SimpleNamespace(input_tokens=len(json.dumps(request['params'])) // 4, output_tokens=len(text) // 4, cache_read_input_tokens=0, cache_creation_input_tokens=0)
+                    message = SimpleNamespace(content=[block], usage=usage)
+                    result = SimpleNamespace(type='succeeded', message=message)
+
+                yield SimpleNamespace(custom_id=request['custom_id'], result=result)
+
+        return iterate()
+
+
+def create_from_env():
+    """Returns a FakeBatches object if enabled via the environment, or None."""
+
+    duration = os.environ.get('ANTHROPIC_FAKE_BATCHES')
+    if not duration:
+        return None
+
+    return FakeBatches(float(duration))
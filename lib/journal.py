@@ -0,0 +1,342 @@
+"""Stores the message history of a session as an append-only journal.  New
+messages are appended as they are, while changes to earlier messages are
+appended as records that are replayed when the session is loaded, so that no
+change requires rewriting the whole file.  Once enough of those records have
+built up, the file is compacted in the background.
+
+The writing is done by a background thread, so that the event loop doesn't
+wait for the disk.  How soon the records are made durable depends on the
+durability policy of the journal:
+
+- "message": every batch of records is written and fsynced right away.
+- "group": records are handed to the OS right away, so they survive the bot
+  crashing, and fsynced together at most every group_commit_interval
+  seconds, so a power failure loses at most that much.
+- "rollover": records are handed to the OS right away, but only fsynced when
+  the session is closed, so a power failure may lose all of them.
+"""
+
+import asyncio
+import atexit
+import concurrent.futures
+import json
+import os
+import pathlib
+import queue
+import sqlite3
+import threading
+import time
+
+from .msgtypes import message_from_dict
+
+# Number of records modifying earlier messages after which the journal is
+# rewritten to contain just the current messages
+JOURNAL_COMPACT_RECORDS = 100
+
+DURABILITY_POLICIES = ('message', 'group', 'rollover')
+DEFAULT_DURABILITY = 'rollover'
+
+# Default number of seconds between group commits
+GROUP_COMMIT_INTERVAL = 0.05
+
+# Errors the writer thread reports and carries on after
+WRITE_ERRORS = (OSError, sqlite3.Error)
+
+
+def replay(lines):
+    """Rebuilds the message history from the lines of a journal.  Returns the
+    messages and the number of records that modified earlier messages."""
+
+    messages = []
+    records = 0
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            obj = json.loads(line)
+        except json.JSONDecodeError:
+            # Most likely the last line was cut off by a crash
+            print(f"Skipping corrupt journal line: {line[:100]}")
+            continue
+
+        op = obj.get("op")
+        if op is None:
+            messages.append(message_from_dict(obj))
+            continue
+
+        records += 1
+        if op == "edit":
+            messages[obj["index"]] = message_from_dict(obj["message"])
+        elif op == "delete":
+            del messages[obj["index"]]
+        elif op == "replace_range":
+            messages[obj["start"]:obj["end"]] = [message_from_dict(msg) for msg in obj["messages"]]
+        else:
+            raise RuntimeError(f"encountered unexpected journal record {op!r}")
+
+    return messages, records
+
+
+def _write_messages(path, messages):
+    with open(path, 'w') as fh:
+        for message in messages:
+            fh.write(json.dumps(message.to_dict()) + "\n")
+        fh.flush()
+        os.fsync(fh.fileno())
+
+
+class JournalWriter:
+    """Performs the writes of all session journals in a background thread,
+    in the order in which they were submitted.  Anything with the same
+    writer-side methods as SessionJournal can be written through it, like the
+    session database in lib/store.py."""
+
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, journal, op, arg=None):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='journal-writer', daemon=True)
+                self.thread.start()
+                atexit.register(self.stop)
+
+        self.queue.put((journal, op, arg))
+
+    def stop(self):
+        """Writes out everything that was submitted and stops the thread."""
+
+        with self.lock:
+            thread = self.thread
+            self.thread = None
+
+        if thread is not None:
+            self.queue.put((None, 'stop', None))
+            thread.join()
+
+    def run(self):
+        # Journals with written records waiting for a group commit
+        pending = set()
+        # Journals with an open file
+        open_journals = set()
+
+        while True:
+            timeout = None
+            if pending:
+                timeout = max(0.0, min(journal._deadline for journal in pending) - time.monotonic())
+
+            try:
+                items = [self.queue.get(timeout=timeout)]
+            except queue.Empty:
+                items = []
+
+            # Take everything that has built up, so it's written together
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = False
+            written = set()
+            waiting = []
+            for journal, op, arg in items:
+                if op == 'stop':
+                    stop = True
+                    continue
+
+                try:
+                    if op == 'write':
+                        journal._write(arg)
+                        open_journals.add(journal)
+                        written.add(journal)
+
+                    elif op == 'compact':
+                        pending.discard(journal)
+                        open_journals.discard(journal)
+                        written.discard(journal)
+                        journal._compact(arg)
+
+                    elif op == 'wait':
+                        waiting.append(arg)
+
+                    elif op == 'close':
+                        pending.discard(journal)
+                        open_journals.discard(journal)
+                        written.discard(journal)
+                        journal._close()
+
+                except WRITE_ERRORS as ex:
+                    print(f"Failed to write {journal.path}: {ex}")
+
+                finally:
+                    if op == 'close':
+                        arg.set_result(None)
+
+            # Everything written in one go is committed together
+            for journal in written:
+                try:
+                    if journal.durability == 'message':
+                        journal._sync()
+                    else:
+                        journal._flush()
+
+                    if journal.durability == 'group' and journal not in pending:
+                        journal._deadline = time.monotonic() + journal.group_commit_interval
+                        pending.add(journal)
+                except WRITE_ERRORS as ex:
+                    print(f"Failed to write {journal.path}: {ex}")
+
+            for future in waiting:
+                future.set_result(None)
+
+            now = time.monotonic()
+            for journal in list(pending):
+                if stop or journal._deadline <= now:
+                    pending.discard(journal)
+                    try:
+                        journal._sync()
+                    except WRITE_ERRORS as ex:
+                        print(f"Failed to write {journal.path}: {ex}")
+
+            if stop:
+                for journal in open_journals:
+                    try:
+                        journal._close()
+                    except WRITE_ERRORS as ex:
+                        print(f"Failed to write {journal.path}: {ex}")
+                return
+
+
+writer = JournalWriter()
+
+
+class SessionJournal:
+    """Appends records to the journal file of a session.  Records are handed
+    to the writer thread when flush() is called, and written to disk according
+    to the durability policy."""
+
+    def __init__(self, path, records=0, durability=DEFAULT_DURABILITY, group_commit_interval=GROUP_COMMIT_INTERVAL):
+        assert durability in DURABILITY_POLICIES, f"Invalid durability policy '{durability}'"
+
+        self.path = pathlib.Path(path)
+        self.durability = durability
+        self.group_commit_interval = group_commit_interval
+
+        # Number of records modifying earlier messages in the file
+        self.records = records
+
+        # Lines not yet handed to the writer
+        self.__lines = []
+
+        # Only used by the writer thread
+        self._file = None
+        self._deadline = None
+
+    def __write(self, obj, modifies=False):
+        self.__lines.append(json.dumps(obj) + "\n")
+        if modifies:
+            self.records += 1
+
+    def append(self, messages):
+        """Records new messages at the end of the history."""
+        for message in messages:
+            self.__write(message.to_dict())
+
+    def edit(self, index, message):
+        """Records that the message at the given index has changed."""
+        self.__write({"op": "edit", "index": index, "message": message.to_dict()}, modifies=True)
+
+    def delete(self, index):
+        """Records that the message at the given index has been removed."""
+        self.__write({"op": "delete", "index": index}, modifies=True)
+
+    def replace_range(self, start, end, messages):
+        """Records that the messages from start up to end have been replaced
+        by the given messages."""
+        self.__write({"op": "replace_range", "start": start, "end": end, "messages": [message.to_dict() for message in messages]}, modifies=True)
+
+    def flush(self):
+        if self.__lines:
+            writer.submit(self, 'write', self.__lines)
+            self.__lines = []
+
+    async def wait_written(self):
+        """Waits until everything recorded so far has been written out as far
+        as the durability policy requires right away: fsynced under "message",
+        handed to the OS otherwise."""
+
+        self.flush()
+        future = concurrent.futures.Future()
+        writer.submit(self, 'wait', future)
+        await asyncio.wrap_future(future)
+
+    async def close(self):
+        """Waits until everything recorded so far has been written and
+        fsynced, eg. at the end of the session.  Records can still be added
+        afterwards."""
+
+        self.flush()
+        future = concurrent.futures.Future()
+        writer.submit(self, 'close', future)
+        await asyncio.wrap_future(future)
+
+    def maybe_compact(self, messages):
+        """Has the journal compacted in the background if enough records
+        have built up.  messages should be the current message history."""
+
+        if self.records < JOURNAL_COMPACT_RECORDS:
+            return
+
+        # Changes made from here on are recorded on top of this snapshot
+        self.flush()
+        writer.submit(self, 'compact', list(messages))
+        self.records = 0
+
+    # The following are called by the writer thread
+
+    def _write(self, lines):
+        if self._file is None:
+            self._file = self.path.open('a')
+
+        self._file.writelines(lines)
+
+    def _flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def _sync(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def _close(self):
+        if self._file is not None:
+            file = self._file
+            self._file = None
+            file.flush()
+            os.fsync(file.fileno())
+            file.close()
+
+    def _compact(self, snapshot):
+        """Rewrites the journal to contain just the given messages.  The new
+        file is atomically renamed over the old one, so the old one stays
+        intact if anything goes wrong.  Records submitted after the snapshot
+        was taken are written to the new file."""
+
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        try:
+            _write_messages(tmp_path, snapshot)
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            os.replace(tmp_path, self.path)
+
+        except OSError as ex:
+            print(f"Failed to compact {self.path}: {ex}")
+            if tmp_path.exists():
+                tmp_path.unlink()
@@ -0,0 +1,357 @@
+"""Tolerant extraction of JSON values from LLM output, which may be surrounded
+by prose or code fences, contain comments or trailing commas, contain
+unescaped characters in strings, or have been cut off before the end."""
+
+import json
+import re
+
+CONTROL_ESCAPES = {'\n': '\\n', '\r': '\\r', '\t': '\\t', '\b': '\\b', '\f': '\\f'}
+VALID_ESCAPES = '"\\/bfnrtu'
+CLOSERS = {'{': '}', '[': ']'}
+LITERALS = ('true', 'false', 'null')
+
+# A unicode escape cut off partway, or a high surrogate whose low half was cut
+# off, at the end of a truncated string
+PARTIAL_ESCAPE = re.compile(r'\\u(?:[dD][89abAB][0-9a-fA-F]{2}|[0-9a-fA-F]{0,3})$')
+
+
+class JSONExtractor:
+    """Incrementally scans model output for a JSON value, producing a cleaned
+    up version of it as it goes.  Text may be passed in in pieces via feed(),
+    after which close() returns the parsed value.  The repairs that were
+    necessary are listed in the repairs attribute."""
+
+    def __init__(self, start_chars='{['):
+        self.start_chars = start_chars
+        self.repairs = []
+
+        self.__text = ''
+        self.__pos = 0
+        self.__out = []
+        self.__state = 'before'
+        self.__string_is_key = False
+        self.__skipped = ''
+
+        # Stack of [opening bracket, whether a key is expected next]
+        self.__stack = []
+
+        # Output length and stack at the last point where the value could be
+        # cut off and closed, for recovering truncated output
+        self.__safe = (0, ())
+
+    def repair(self, description):
+        if description not in self.repairs:
+            self.repairs.append(description)
+
+    @property
+    def done(self):
+        "True if a complete value has been found."
+        return self.__state == 'done'
+
+    def feed(self, text):
+        """Processes the next piece of model output."""
+        self.__text += text
+        self.__scan(final=False)
+        return self
+
+    def close(self):
+        """Processes the remaining output and returns the parsed value, or
+        raises ValueError if no JSON value could be recovered."""
+
+        self.__scan(final=True)
+
+        if self.__state == 'before':
+            raise ValueError("No JSON value found in response")
+
+        if '```' in self.__skipped:
+            self.repair("removed code fence")
+
+        if self.__state == 'done':
+            if self.__text[self.__pos:].strip(' \t\r\n`'):
+                self.repair("ignored trailing text")
+            return json.loads(self.text, strict=False)
+
+        # The output was truncated.  First try closing off whatever we have.
+        out = self.__out[:]
+        stack = [entry[0] for entry in self.__stack]
+        completed = False
+        if self.__state in ('string', 'escape'):
+            if self.__string_is_key:
+                out = None
+            else:
+                out = list(PARTIAL_ESCAPE.sub('', ''.join(out))) + ['"']
+        elif self.__state == 'value':
+            out, completed = self.__complete_literal(out)
+
+        if out is not None:
+            try:
+                value = self.__close_truncated(out, stack)
+            except json.JSONDecodeError:
+                pass
+            else:
+                if completed:
+                    self.repair("completed truncated literal")
+                return value
+
+        # Otherwise, go back to the last point where a value was completed,
+        # unless that would leave nothing of what was there
+        length, stack = self.__safe
+        dropped = ''.join(self.__out[length:]).strip()
+        value = self.__close_truncated(self.__out[:length], stack)
+        if not value and dropped:
+            raise ValueError("Truncated JSON could not be recovered")
+        return value
+
+    @property
+    def text(self):
+        "The cleaned up JSON text scanned so far."
+        return ''.join(self.__out)
+
+    def __complete_literal(self, out):
+        """Completes a literal that was cut off partway, like tru.  Returns
+        the output and whether it was changed."""
+
+        i = len(out)
+        while i > 0 and out[i - 1].isalpha():
+            i -= 1
+
+        word = ''.join(out[i:])
+        if word and word not in LITERALS:
+            for literal in LITERALS:
+                if literal.startswith(word):
+                    return out[:i] + list(literal), True
+
+        return out, False
+
+    def __close_truncated(self, out, stack):
+        text = ''.join(out).rstrip()
+        if text.endswith(','):
+            text = text[:-1]
+        text += ''.join(CLOSERS[char] for char in reversed(stack))
+        value = json.loads(text, strict=False)
+
+        self.repair("closed truncated JSON")
+        self.__out = list(text)
+        return value
+
+    def __mark_safe(self):
+        self.__safe = (len(self.__out), tuple(entry[0] for entry in self.__stack))
+
+    def __lookahead(self, pos, final):
+        """Returns the next non-whitespace character at or after pos, '' at the
+        end of the text, or None if more text is needed to know."""
+
+        text = self.__text
+        while pos < len(text) and text[pos].isspace():
+            pos += 1
+
+        if pos < len(text):
+            return text[pos]
+        return '' if final else None
+
+    def __scan(self, final):
+        text = self.__text
+        out = self.__out
+        stack = self.__stack
+        pos = self.__pos
+
+        while pos < len(text) and self.__state != 'done':
+            char = text[pos]
+            state = self.__state
+
+            if state == 'before':
+                if char in self.start_chars:
+                    if pos > 0 and self.__skipped.strip():
+                        self.repair("stripped text before JSON")
+                    out.append(char)
+                    stack.append([char, char == '{'])
+                    self.__state = 'value'
+                    self.__mark_safe()
+                else:
+                    self.__skipped += char
+                pos += 1
+
+            elif state == 'string':
+                if char == '\\':
+                    self.__state = 'escape'
+                    pos += 1
+
+                elif char == '"':
+                    # Is this really the end of the string?  If it isn't
+                    # followed by a delimiter, it's a quote that should have
+                    # been escaped.
+                    next_char = self.__lookahead(pos + 1, final)
+                    if next_char is None:
+                        break
+
+                    if next_char in ('', ':') if self.__string_is_key else next_char in ('', ',', '}', ']', '/', '#'):
+                        out.append('"')
+                        self.__state = 'value'
+                        if not self.__string_is_key:
+                            self.__mark_safe()
+                    else:
+                        self.repair("escaped stray quote in string")
+                        out.append('\\"')
+                    pos += 1
+
+                elif char in CONTROL_ESCAPES or ord(char) < 0x20:
+                    self.repair("escaped control character in string")
+                    out.append(CONTROL_ESCAPES.get(char) or f'\\u{ord(char):04x}')
+                    pos += 1
+
+                else:
+                    out.append(char)
+                    pos += 1
+
+            elif state == 'escape':
+                if char in VALID_ESCAPES:
+                    out.append('\\' + char)
+                elif char == "'":
+                    self.repair("removed invalid escape")
+                    out.append(char)
+                else:
+                    self.repair("escaped stray backslash")
+                    out.append('\\\\' + char)
+                self.__state = 'string'
+                pos += 1
+
+            elif state == 'line_comment':
+                if char == '\n':
+                    self.__state = 'value'
+                    out.append(char)
+                pos += 1
+
+            elif state == 'block_comment':
+                if char == '*':
+                    if pos + 1 >= len(text) and not final:
+                        break
+                    if text[pos + 1:pos + 2] == '/':
+                        self.__state = 'value'
+                        pos += 1
+                pos += 1
+
+            elif char == '"':
+                self.__string_is_key = stack[-1][0] == '{' and stack[-1][1]
+                self.__state = 'string'
+                out.append(char)
+                pos += 1
+
+            elif char == '#':
+                self.repair("removed comment")
+                self.__state = 'line_comment'
+                pos += 1
+
+            elif char == '/':
+                if pos + 1 >= len(text) and not final:
+                    break
+                next_char = text[pos + 1:pos + 2]
+                if next_char == '/':
+                    self.repair("removed comment")
+                    self.__state = 'line_comment'
+                    pos += 2
+                elif next_char == '*':
+                    self.repair("removed comment")
+                    self.__state = 'block_comment'
+                    pos += 2
+                else:
+                    out.append(char)
+                    pos += 1
+
+            elif char in '{[':
+                out.append(char)
+                stack.append([char, char == '{'])
+                self.__mark_safe()
+                pos += 1
+
+            elif char in '}]':
+                # Drop a trailing comma before the closing bracket
+                i = len(out) - 1
+                while i >= 0 and out[i].isspace():
+                    i -= 1
+                if i >= 0 and out[i] == ',':
+                    self.repair("removed trailing comma")
+                    del out[i]
+
+                if CLOSERS[stack[-1][0]] != char:
+                    self.repair("fixed mismatched bracket")
+                    char = CLOSERS[stack[-1][0]]
+
+                out.append(char)
+                stack.pop()
+                pos += 1
+
+                if not stack:
+                    self.__state = 'done'
+                else:
+                    self.__mark_safe()
+
+            elif char == ',':
+                self.__mark_safe()
+                if stack[-1][0] == '{':
+                    stack[-1][1] = True
+                out.append(char)
+                pos += 1
+
+            elif char == ':':
+                stack[-1][1] = False
+                out.append(char)
+                pos += 1
+
+            else:
+                out.append(char)
+                pos += 1
+
+        self.__pos = pos
+
+
+def extract_json(text, return_type=dict):
+    """Extracts a JSON value of the given type (dict or list) from the given
+    model output.  Returns the value, the cleaned up JSON text and a list of
+    descriptions of the repairs that were made.  Raises ValueError if no
+    value of that type could be recovered.
+
+    >>> extract_json('Sure! {"a": [1, 2,], "b": "x')[0]
+    {'a': [1, 2], 'b': 'x'}
+    >>> extract_json('{"a": 1, "b": tru')[0]
+    {'a': 1, 'b': True}
+    >>> extract_json('{"a": 1, "b": n')[0]
+    {'a': 1, 'b': None}
+    >>> extract_json('{"a": "x\\\\u00')[0]
+    {'a': 'x'}
+    >>> extract_json('[{"a": 1}, {"b": 2}]', dict)
+    Traceback (most recent call last):
+    ...
+    ValueError: Expected a JSON object, not a list
+    """
+
+    extractor = JSONExtractor()
+    extractor.feed(text)
+    value = extractor.close()
+
+    # Don't dig into a value of the wrong type
+    if return_type in (dict, list) and not isinstance(value, return_type):
+        raise ValueError(f"Expected a JSON {'object' if return_type is dict else 'array'}, not a {type(value).__name__}")
+
+    return value, extractor.text, extractor.repairs
+
+
+def extract_partial_string(text, key):
+    """Returns the (possibly still incomplete) value of the string stored under
+    the given top-level key of a JSON object that is still being generated, or
+    None if that value has not started yet.
+
+    >>> extract_partial_string('{"impression": "fine", "chat": "Hel', 'chat')
+    'Hel'
+    >>> extract_partial_string('{"impression": "fi', 'chat') is None
+    True
+    """
+
+    extractor = JSONExtractor('{')
+    extractor.feed(text)
+    try:
+        value = extractor.close()
+    except ValueError:
+        return None
+
+    value = value.get(key)
+    return value if isinstance(value, str) else None
@@ -0,0 +1,66 @@
+"""Keeps a manifest of the sessions of each assistant, updated when a session
+is created or closed, so that finding the previous session or listing the
+sessions doesn't require probing for session files and parsing them.  The
+number of messages and last activity of the current session are only
+brought up to date when it is closed."""
+
+import sqlite3
+from datetime import date, datetime, timezone
+
+# Fields that can be recorded for a session; None means unknown
+FIELDS = ('messages', 'last_activity', 'summary', 'diary', 'ltm')
+
+
+class SessionManifest:
+    """The manifest database, with one row per session."""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS sessions (
+            assistant TEXT, date TEXT, messages INTEGER, last_activity REAL,
+            summary INTEGER, diary INTEGER, ltm INTEGER,
+            PRIMARY KEY (assistant, date))""")
+        self.db.commit()
+
+    def update(self, assistant_id, session_date, **fields):
+        """Records the given fields of a session, which are the number of
+        messages, the time of the last activity as a UNIX time, and whether
+        a summary, diary entry or long-term memory update exists for it."""
+
+        assert all(field in FIELDS for field in fields)
+
+        self.db.execute("INSERT OR IGNORE INTO sessions (assistant, date) VALUES (?, ?)", (assistant_id, session_date.isoformat()))
+        if fields:
+            assignments = ', '.join(f'{field} = ?' for field in fields)
+            self.db.execute(f"UPDATE sessions SET {assignments} WHERE assistant = ? AND date = ?",
+                            tuple(fields.values()) + (assistant_id, session_date.isoformat()))
+        self.db.commit()
+
+    def has_sessions(self, assistant_id):
+        return self.db.execute("SELECT 1 FROM sessions WHERE assistant = ? LIMIT 1", (assistant_id, )).fetchone() is not None
+
+    def find_before(self, assistant_id, session_date, earliest=None):
+        """Returns the date of the last session before (not on) the given
+        date, and not before earliest, or None."""
+
+        row = self.db.execute("SELECT date FROM sessions WHERE assistant = ? AND date < ? AND date >= ? ORDER BY date DESC LIMIT 1",
+                              (assistant_id, session_date.isoformat(), earliest.isoformat() if earliest else '')).fetchone()
+        return date.fromisoformat(row[0]) if row else None
+
+    def list(self, assistant_id):
+        """Returns a dict describing each session of the given assistant, in
+        order of date."""
+
+        sessions = []
+        rows = self.db.execute(f"SELECT date, {', '.join(FIELDS)} FROM sessions WHERE assistant = ? ORDER BY date", (assistant_id, ))
+        for row in rows:
+            info = dict(zip(('date', ) + FIELDS, row))
+            info['date'] = date.fromisoformat(info['date'])
+            if info['last_activity'] is not None:
+                info['last_activity'] = datetime.fromtimestamp(info['last_activity'], tz=timezone.utc)
+            for field in ('summary', 'diary', 'ltm'):
+                if info[field] is not None:
+                    info[field] = bool(info[field])
+            sessions.append(info)
+
+        return sessions
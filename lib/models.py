@@ -1,28 +1,228 @@
-import requests
 import json
-import re
 from base64 import standard_b64encode
 import logging
 from abc import ABC, abstractmethod
 from typing import List, Dict, Tuple, Optional
-import anthropic
-from anthropic.types.message_create_params import MessageCreateParamsNonStreaming
-from anthropic.types.messages.batch_create_params import Request
-from openai import AsyncOpenAI
 import os
-from datetime import datetime, timezone
+import hashlib
+import random
+import string
+import time
+from datetime import datetime, timezone, timedelta
 import asyncio
+from collections import defaultdict, deque, OrderedDict
 from contextvars import ContextVar
 
-from .msgtypes import Role, Message, AssistantMessage, Attachment
-from .util import translate_cites
+from .msgtypes import Role, Message, AssistantMessage, ContextMessage, Attachment
+from .util import translate_cites, estimate_tokens, CHARS_PER_TOKEN
+from .jsonrepair import extract_json
+from .cache import EncodedMessageCache, estimate_size
+from . import accounting, batches, fakebatch, ratelimit
 
 # Time in seconds between checking whether a batch is done.
 BATCH_CHECK_DELAY = 60.0
 BATCH_CHECK_BACKOFF = 1.5
+BATCH_CHECK_MAX_DELAY = 900.0
+
+# Address of the Ollama server, unless overridden by $OLLAMA_HOST
+OLLAMA_DEFAULT_HOST = "http://localhost:11434"
+
+# How long Ollama should keep the model loaded after a request, unless
+# overridden by $OLLAMA_KEEP_ALIVE.  Use -1 to keep it loaded indefinitely.
+OLLAMA_DEFAULT_KEEP_ALIVE = "30m"
+
+# Max number of simultaneous connections to the Ollama server, and how long in
+# seconds to keep idle connections open for reuse.
+OLLAMA_POOL_SIZE = 4
+OLLAMA_POOL_KEEPALIVE = 300.0
+
+# Failed requests are retried up to this many times in total, waiting
+# exponentially longer each time, from RETRY_BASE_DELAY up to RETRY_MAX_DELAY
+# seconds.  If the provider asks us to wait longer than that, we give up.
+MAX_REQUEST_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+
+# After this many consecutive calls to a model have failed, each after all of
+# its attempts, calls to it fail immediately until CIRCUIT_RESET_TIME seconds
+# have passed.  Other models of the same provider, eg. fallbacks, aren't
+# affected.
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIME = 60.0
+
+# A composite model sends a second, hedged request to the next model when the
+# first one takes longer than this percentile of its recent response times
+HEDGE_LATENCY_PERCENTILE = 0.9
+HEDGE_LATENCY_SAMPLES = 100
+HEDGE_MIN_SAMPLES = 10
+
+# Hedge delay used until enough response times have been measured
+HEDGE_DEFAULT_DELAY = 30.0
+
+# Responses generated by the fake model, unless a script is given.  $message
+# is replaced by the last message and $count by the number of the response.
+FAKE_RESPONSE_TEMPLATES = {
+    str: "Fake response $count to: $message",
+    dict: '{"impression": "Fake impression", "intentions": "Fake intentions", "chat": "Fake response $count to: $message", "prompt_after": 30}',
+    list: '[]',
+}
+
+# Maximum number of Gemini clients that are kept around for reuse
+GEMINI_CLIENT_CACHE_SIZE = 8
+
+# System prompts of at least this many tokens are stored in a Gemini context
+# cache, if the model supports it, for this long.  Gemini refuses to cache
+# anything shorter than this.
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = 32768
+GEMINI_CONTEXT_CACHE_TTL = timedelta(hours=1)
+
+
+class PromptCacheStats:
+    """Keeps track of how much of the input of a model was served from the
+    provider's prompt cache."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.read_tokens = 0
+        self.written_tokens = 0
+        self.uncached_tokens = 0
+
+    def record(self, read_tokens=0, written_tokens=0, uncached_tokens=0):
+        if read_tokens:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+        self.read_tokens += read_tokens
+        self.written_tokens += written_tokens
+        self.uncached_tokens += uncached_tokens
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __str__(self):
+        return (f'{self.hits} hits, {self.misses} misses ({self.hit_rate:.0%}); '
+                f'{self.read_tokens} tokens read from cache, '
+                f'{self.written_tokens} written, {self.uncached_tokens} uncached')
+
+
+# Prompt cache statistics, by model name
+prompt_cache_stats = defaultdict(PromptCacheStats)
+
+
+class ModelError(Exception):
+    """Raised when a request to the model provider failed, as opposed to the
+    model producing an invalid response."""
+
+    def __init__(self, message, status=None, retryable=False, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(ModelError):
+    """Raised instead of making a request to a provider that has been failing
+    consistently."""
+
+
+class CircuitBreaker:
+    """Keeps track of consecutive failed calls to a model, and stops requests
+    from being made for a while if there are too many."""
+
+    def __init__(self, name, threshold=CIRCUIT_FAILURE_THRESHOLD, reset_time=CIRCUIT_RESET_TIME):
+        self.name = name
+        self.threshold = threshold
+        self.reset_time = reset_time
+        self.failures = 0
+        self.opened_at = None
+
+    def check(self):
+        """Raises CircuitOpenError if no requests should be made right now."""
+
+        if self.opened_at is None:
+            return
+
+        remaining = self.opened_at + self.reset_time - time.monotonic()
+        if remaining > 0:
+            raise CircuitOpenError(f"{self.name} is failing, not trying again for another {remaining:.0f} seconds", retry_after=remaining)
+
+        # Let a request through to see whether it has recovered; if this one
+        # fails as well, the circuit opens again right away
+        self.opened_at = None
+        self.failures = self.threshold - 1
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold and self.opened_at is None:
+            print(f"Too many failed calls to {self.name}, pausing requests for {self.reset_time:.0f} seconds")
+            self.opened_at = time.monotonic()
+
+
+# Circuit breakers, by provider and model name
+circuit_breakers = {}
+
+
+def get_retry_after(ex):
+    """Returns the number of seconds the server asked us to wait before trying
+    again, if it was included in the response that caused the exception."""
+
+    headers = getattr(getattr(ex, 'response', None), 'headers', None)
+    if not headers:
+        return None
+
+    value = headers.get('retry-after-ms')
+    if value:
+        try:
+            return float(value) / 1000.0
+        except ValueError:
+            pass
+
+    value = headers.get('retry-after')
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+
+    return None
+
+
+def classify_error(ex):
+    """Converts an exception raised while making a request into a ModelError
+    indicating whether it makes sense to retry it, or returns None if it was
+    not caused by the request failing."""
+
+    if isinstance(ex, ModelError):
+        return ex
+
+    # The various SDKs agree on the names, but don't share base classes
+    names = [cls.__name__ for cls in type(ex).__mro__]
+    if isinstance(ex, (asyncio.TimeoutError, ConnectionError)) or \
+       any('Timeout' in name or 'Connection' in name or name == 'DeadlineExceeded' for name in names):
+        return ModelError(f"Request failed: {ex}", retryable=True, retry_after=get_retry_after(ex))
+
+    status = getattr(ex, 'status_code', None)
+    if not isinstance(status, int):
+        status = getattr(ex, 'code', None)
+    if not isinstance(status, int) or status < 400:
+        return None
+
+    retryable = status in (408, 409, 425, 429) or status >= 500
+    return ModelError(f"Request failed with status {status}: {ex}", status=status, retryable=retryable, retry_after=get_retry_after(ex))
 
 
 class Model(ABC):
+    # Used to group models by provider for rate limiting
+    provider = None
+
     def __init__(self, model_name: str, system_prompt: str = "", temperature: float = 0, max_tokens: int = 1024, logger=None):
         self.model_name = model_name
         self.system_prompt = system_prompt
@@ -34,7 +234,15 @@ class Model(ABC):
         # Default implementation just runs everything one by one
         return [await call for call in calls]
 
-    async def query(self, messages: List[Message], system_prompt=None, validate_func=None, return_type=str) -> str:
+    def is_batching(self):
+        """Returns True if requests made in the current context are collected
+        into a batch rather than being sent right away."""
+        return False
+
+    async def query(self, messages: List[Message], system_prompt=None, validate_func=None, return_type=str, on_partial=None) -> str:
+        """Queries the model and returns the validated response.  If on_partial
+        is given, it is called with the accumulated response text every time
+        a new chunk of the response comes in."""
         temperature = self.temperature
         max_attempts = int((1.0 - temperature) / 0.1) + 1  # Calculate max attempts to reach t=1.0
 
@@ -46,7 +254,15 @@ class Model(ABC):
                 self.logger.info(f"Querying model (Attempt {attempt + 1}, Temperature: {temperature})")
             self.logger.info(f"User message: {messages[-1].content}")
 
-            response_messages = await self.chat_completion(messages, self.model_name, temperature, self.max_tokens, system_prompt, return_type)
+            try:
+                response_messages = await self.request_completion(messages, temperature, system_prompt, return_type, on_partial=on_partial)
+            except ModelError:
+                raise
+            except Exception as ex:
+                # Most likely a response we couldn't make sense of
+                self.logger.exception(f"Failed to process model response: {ex}")
+                response_messages = []
+
             self.logger.info(f"Model response: {response_messages}")
             valid_messages = []
 
@@ -56,39 +272,17 @@ class Model(ABC):
 
                 valid = True
                 if return_type is not str:
-                    # Some models will output text other than the JSON response
-                    # Best way to find the JSON alone would be to specifically get everything from the { to the }
-                    if return_type is list and "[" in message.content:
-                        begin = message.content.find("[")
-                        end = message.content.rfind("]")
-                        if begin < 0 or end < begin:
-                            valid = False
-                        else:
-                            message.content = message.content[begin:end + 1]
-
-                    elif return_type is dict and "{" in message.content:
-                        begin = message.content.find("{")
-                        end = message.content.rfind("}")
-                        if begin < 0 or end < begin:
-                            valid = False
-                        else:
-                            message.content = message.content[begin:end + 1]
-
-                    if not message.content:
+                    # Some models will output text other than the JSON response,
+                    # or slightly malformed JSON, which we can often fix up
+                    if not message.content or message.content.isspace():
                         response = None
                     else:
                         try:
-                            response = json.loads(message.content, strict=False)
-                        except json.JSONDecodeError:
-                            # Remove comments
-                            if '//' in message.content or '#' in message.content:
-                                message.content = re.sub(r'([\[\]\{\},"])\s*(//|#).*$', '\\1', message.content, flags=re.MULTILINE)
-                                try:
-                                    response = json.loads(message.content, strict=False)
-                                except json.JSONDecodeError:
-                                    valid = False
-                            else:
-                                valid = False
+                            response, message.content, repairs = extract_json(message.content, return_type)
+                            if repairs:
+                                self.logger.warning(f"Repaired JSON response: {', '.join(repairs)}")
+                        except ValueError:
+                            valid = False
                 else:
                     response = message.content
 
@@ -103,7 +297,8 @@ class Model(ABC):
                 return response
 
             temperature = min(temperature + 0.1, 1.0)
-            self.logger.warning(f"Response: {message.content}")
+            if response_messages:
+                self.logger.warning(f"Response: {response_messages[-1].content}")
             self.logger.warning(f"Invalid response. Increasing temperature to {temperature}")
             await asyncio.sleep(0.25)
 
@@ -111,6 +306,89 @@ class Model(ABC):
         self.logger.error("Failed to get a valid response even at maximum temperature.")
         raise ValueError("Failed to get a valid response from the model")
 
+    async def request_completion(self, messages, temperature, system_prompt, return_type, on_partial=None):
+        """Calls chat_completion, retrying with exponential backoff if the
+        request fails for a reason that may be temporary.  Raises ModelError
+        if the request could not be completed."""
+
+        name = f'{self.provider}/{self.model_name}' if self.provider else self.model_name
+        breaker = circuit_breakers.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(name)
+            circuit_breakers[name] = breaker
+
+        limiter = ratelimit.get_limiter(self.provider or self.model_name)
+        input_tokens = estimate_tokens(system_prompt or '') + sum(message.estimate_tokens() for message in messages)
+
+        # Keep track of the usage, which the implementation reports through
+        # record_usage, to be stored when the call is done
+        call = accounting.CallRecord(accounting.current_caller.get(), limiter.provider, self.model_name, batched=self.is_batching())
+        call_token = accounting.current_call.set(call)
+        start_time = time.monotonic()
+
+        try:
+            for attempt in range(MAX_REQUEST_ATTEMPTS):
+                call.attempts = attempt + 1
+                breaker.check()
+
+                try:
+                    if self.is_batching():
+                        # Batched requests are not subject to the rate limits
+                        result = await self.chat_completion(messages, self.model_name, temperature, self.max_tokens, system_prompt, return_type, on_partial=on_partial)
+                    else:
+                        async with limiter.acquire(input_tokens) as wait:
+                            call.wait += wait
+                            if wait > 0.1:
+                                self.logger.info(f"Waited {wait:.2f} seconds for the {limiter.provider} rate limit")
+                            result = await self.chat_completion(messages, self.model_name, temperature, self.max_tokens, system_prompt, return_type, on_partial=on_partial)
+                    breaker.record_success()
+                    call.success = True
+                    return result
+
+                except Exception as ex:
+                    error = classify_error(ex)
+                    if error is None:
+                        raise
+
+                    delay = min(RETRY_BASE_DELAY * 2 ** attempt, RETRY_MAX_DELAY) * random.uniform(0.5, 1.0)
+                    if error.retry_after is not None:
+                        delay = error.retry_after + random.uniform(0.0, 1.0)
+
+                    if not error.retryable or delay > RETRY_MAX_DELAY + 1.0 or attempt + 1 >= MAX_REQUEST_ATTEMPTS:
+                        # Only the call as a whole counts as a failure
+                        if error.retryable:
+                            breaker.record_failure()
+                        if error is ex:
+                            raise
+                        raise error from ex
+
+                    self.logger.warning(f"{error} (attempt {attempt + 1} of {MAX_REQUEST_ATTEMPTS}), retrying in {delay:.1f} seconds")
+                    await asyncio.sleep(delay)
+
+        finally:
+            accounting.current_call.reset(call_token)
+            call.latency = time.monotonic() - start_time
+            self.logger.info(f"Call for {call.caller} took {call.latency:.2f} seconds in {call.attempts} attempt(s), {call.input_tokens} input tokens, {call.output_tokens} output tokens")
+            accounting.record(call)
+
+    def record_usage(self, read_tokens=0, written_tokens=0, uncached_tokens=0, output_tokens=0):
+        """Called by the provider implementations to report how many input
+        tokens were read from or written to the prompt cache or not cached,
+        and how many tokens were generated."""
+
+        read_tokens = read_tokens or 0
+        written_tokens = written_tokens or 0
+        uncached_tokens = uncached_tokens or 0
+        output_tokens = output_tokens or 0
+
+        call = accounting.current_call.get()
+        if call is not None:
+            call.add_usage(read_tokens, written_tokens, uncached_tokens, output_tokens)
+
+        stats = prompt_cache_stats[self.model_name]
+        stats.record(read_tokens, written_tokens, uncached_tokens)
+        self.logger.info(f"Prompt cache {'hit' if read_tokens else 'miss'}: {read_tokens} tokens read, {written_tokens} written, {uncached_tokens} uncached")
+
     def reset_conversation(self) -> None:
         """
         Reset the conversation history.
@@ -118,49 +396,153 @@ class Model(ABC):
         pass
 
     @abstractmethod
-    async def chat_completion(self, messages: List[Message], model: str, temperature: float, max_tokens: int, system_prompt: str, return_type: type) -> str:
+    async def chat_completion(self, messages: List[Message], model: str, temperature: float, max_tokens: int, system_prompt: str, return_type: type, on_partial=None) -> str:
         """
-        Send a message to the model and get a response.
+        Send a message to the model and get a response.  If on_partial is
+        given, the response should be streamed, calling it with the text
+        received so far whenever more arrives.
         """
         pass
 
 
+async def _openai_chat_completion(client, on_partial=None, **kwargs):
+    """Sends a request to an OpenAI-compatible chat completions endpoint and
+    returns the response text and the usage block, streaming the text to
+    on_partial if given."""
+
+    if on_partial is None:
+        chat_completion = await client.chat.completions.create(**kwargs)
+        return chat_completion.choices[0].message.content, chat_completion.usage
+
+    text = ''
+    usage = None
+    stream = await client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **kwargs)
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            text += chunk.choices[0].delta.content
+            on_partial(text)
+        if getattr(chunk, 'usage', None):
+            usage = chunk.usage
+    return text, usage
+
+
+def _openai_usage(usage):
+    """Extracts the token usage from an OpenAI-style usage block, as keyword
+    arguments for Model.record_usage."""
+
+    if usage is None:
+        return {}
+
+    output_tokens = getattr(usage, 'completion_tokens', 0)
+
+    # DeepSeek reports this differently from OpenAI
+    read_tokens = getattr(usage, 'prompt_cache_hit_tokens', None)
+    if read_tokens is not None:
+        return {"read_tokens": read_tokens, "uncached_tokens": getattr(usage, 'prompt_cache_miss_tokens', 0), "output_tokens": output_tokens}
+
+    details = getattr(usage, 'prompt_tokens_details', None)
+    read_tokens = getattr(details, 'cached_tokens', None) or 0
+    return {"read_tokens": read_tokens, "uncached_tokens": (usage.prompt_tokens or 0) - read_tokens, "output_tokens": output_tokens}
+
+
+def _with_cache_control(encoded):
+    """Returns a copy of the given Anthropic-encoded message with a prompt
+    cache breakpoint set on its last content block."""
+
+    content = encoded["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    else:
+        content = content[:]
+
+    content[-1] = dict(content[-1], cache_control={"type": "ephemeral"})
+    return dict(encoded, content=content)
+
+
 class OllamaModel(Model):
+    provider = 'ollama'
+
     def __init__(self, model_name: str, system_prompt: str = "", temperature: float = 0.0, max_tokens: int = 5000, logger=None):
         super().__init__(model_name, system_prompt, temperature, max_tokens, logger)
 
-    @staticmethod
-    async def chat_completion(messages: List[Message], model: str, temperature: float, max_tokens: int, system_prompt: str, return_type: type) -> Tuple[str, List[Dict[str, str]]]:
+        host = os.getenv('OLLAMA_HOST') or OLLAMA_DEFAULT_HOST
+        if '://' not in host:
+            host = 'http://' + host
+        self.url = host.rstrip('/') + '/api/chat'
+
+        keep_alive = os.getenv('OLLAMA_KEEP_ALIVE') or OLLAMA_DEFAULT_KEEP_ALIVE
+        if keep_alive.lstrip('-').isdigit():
+            keep_alive = int(keep_alive)
+        self.keep_alive = keep_alive
+
+        self.http_session = None
+
+    def get_http_session(self):
+        """Returns the pooled HTTP session, creating it if necessary.  Must be
+        called from within the event loop."""
+
+        if self.http_session is None or self.http_session.closed:
+            import aiohttp
+            connector = aiohttp.TCPConnector(limit=OLLAMA_POOL_SIZE, keepalive_timeout=OLLAMA_POOL_KEEPALIVE)
+            # Generating can take arbitrarily long, so only time out connecting
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=10)
+            self.http_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+        return self.http_session
+
+    async def chat_completion(self, messages: List[Message], model: str, temperature: float, max_tokens: int, system_prompt: str, return_type: type, on_partial=None) -> Tuple[str, List[Dict[str, str]]]:
         messages = [{"role": message.role.value, "content": message.content} for message in messages if message.role != Role.SYSTEM]
         if system_prompt:
             messages.insert(0, {"role": "system", "content": system_prompt})
 
-        url = "http://localhost:11434/api/chat"
-        headers = {
-            "Content-Type": "application/json"
-        }
         data = {
             "model": model,
             "messages": messages,
-            "stream": False,
+            "stream": on_partial is not None,
+            "keep_alive": self.keep_alive,
             "options": {
                 "temperature": temperature,
                 "num_predict": max_tokens
             }
         }
 
-        response = requests.post(url, headers=headers, data=json.dumps(data))
-
-        text_response = ""
-        if response.status_code == 200:
-            text_response = response.json()["message"]["content"]
-        else:
-            text_response = f"Error: {response.status_code}"
+        async with self.get_http_session().post(self.url, json=data) as response:
+            if response.status != 200:
+                text = await response.text()
+                retryable = response.status in (408, 429) or response.status >= 500
+                raise ModelError(f"Ollama returned status {response.status}: {text}", status=response.status, retryable=retryable)
+
+            if not data["stream"]:
+                result = await response.json()
+                self.record_usage(uncached_tokens=result.get("prompt_eval_count"), output_tokens=result.get("eval_count"))
+                return [AssistantMessage(result["message"]["content"])]
+
+            # Streamed responses consist of one JSON object per line
+            text_response = ""
+            async for line in response.content:
+                line = line.strip()
+                if not line:
+                    continue
+
+                chunk = json.loads(line)
+                if "error" in chunk:
+                    raise ModelError("Ollama returned error: " + chunk["error"])
+
+                content = chunk.get("message", {}).get("content")
+                if content:
+                    text_response += content
+                    on_partial(text_response)
+
+                if chunk.get("done"):
+                    self.record_usage(uncached_tokens=chunk.get("prompt_eval_count"), output_tokens=chunk.get("eval_count"))
+                    break
 
-        return [AssistantMessage(text_response)]
+            return [AssistantMessage(text_response)]
 
 
 class AnthropicModel(Model):
+    provider = 'anthropic'
+
     def __init__(self, model_name: str, system_prompt: str = "", temperature: float = 0.0, max_tokens: int = 4000, logger=None):
         if model_name == "claude-opus" or model_name == "claude-opus-4-5":
             model_name = "claude-opus-4-5-20251101" # $5/$25
@@ -186,10 +568,19 @@ class AnthropicModel(Model):
             model_name = "claude-3-7-sonnet-20250219"
             print(f"Invalid model specified. Defaulting to {model_name}.")
         super().__init__(model_name, system_prompt, temperature, max_tokens, logger)
-        self.client = anthropic.AsyncAnthropic()
+        import anthropic
+        http_client = anthropic.DefaultAsyncHttpxClient(event_hooks=ratelimit.httpx_event_hooks(self.provider))
+        # request_completion does the retrying, so the SDK shouldn't
+        self.client = anthropic.AsyncAnthropic(http_client=http_client, max_retries=0)
+        self.batches = fakebatch.create_from_env() or self.client.messages.batches
         self.batcher = ContextVar('batcher', default=None)
+        self.encoded_cache = EncodedMessageCache()
 
     async def encode_message(self, message):
+        encoded = self.encoded_cache.get(message)
+        if encoded is not None:
+            return encoded
+
         encoded = {"role": message.role.value}
         if message.attachments:
             encoded["content"] = []
@@ -205,11 +596,41 @@ class AnthropicModel(Model):
                 encoded["content"].append({"type": "image", "source": source})
         else:
             encoded["content"] = message.content
+
+        self.encoded_cache.put(message, encoded)
         return encoded
 
-    async def chat_completion(self, messages=[], model='claude-3-haiku-20240307', temperature=0.0, max_tokens=1024, system_prompt="", return_type=str):
+    async def chat_completion(self, messages=[], model='claude-3-haiku-20240307', temperature=0.0, max_tokens=1024, system_prompt="", return_type=str, on_partial=None):
         # Check if the first message is a system message - if it is, we need to not pass it to Anthropic
-        clean_messages = [await self.encode_message(message) for message in messages if message.role != Role.SYSTEM]
+        messages = [message for message in messages if message.role != Role.SYSTEM]
+        clean_messages = [await self.encode_message(message) for message in messages]
+
+        # The recent messages are sent in full and reduced on later turns, so
+        # only the messages before the first of those are sent the same way
+        # next turn.  That prefix is what the next turn can read from cache.
+        stable_index = -1
+        for i, message in enumerate(messages):
+            if isinstance(message, ContextMessage) or not message.is_reduced():
+                break
+            stable_index = i
+
+        # Also cache everything up to the volatile context, or the whole
+        # conversation if there is none, for queries that send the history
+        # without reducing it
+        cache_index = len(messages) - 1
+        for i, message in enumerate(messages):
+            if isinstance(message, ContextMessage):
+                cache_index = i - 1
+                break
+
+        for index in {stable_index, cache_index}:
+            if index >= 0 and clean_messages[index]["content"]:
+                clean_messages[index] = _with_cache_control(clean_messages[index])
+
+        if system_prompt:
+            system = [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+        else:
+            system = system_prompt
 
         # Prefill to increase changes of generating the right type
         prefill = ''
@@ -229,60 +650,89 @@ class AnthropicModel(Model):
                 "max_uses": 5
             })
 
-        try:
-            chat_completion = await self._do_request(
-                system=system_prompt,
-                model=model,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                messages=clean_messages,
-                tools=tools
-            )
+        if prefill and on_partial is not None:
+            stream_callback = lambda text: on_partial(prefill + text)
+        else:
+            stream_callback = on_partial
+
+        chat_completion = await self._do_request(
+            on_partial=stream_callback,
+            system=system,
+            model=model,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            messages=clean_messages,
+            tools=tools
+        )
 
-            messages = []
-            searches = []
-            for content in chat_completion.content:
-                if content.text:
-                    if prefill:
-                        text_response = prefill + content.text
-                        prefill = None
-                    else:
-                        text_response = content.text
+        usage = chat_completion.usage
+        self.record_usage(
+            read_tokens=getattr(usage, 'cache_read_input_tokens', 0),
+            written_tokens=getattr(usage, 'cache_creation_input_tokens', 0),
+            uncached_tokens=usage.input_tokens,
+            output_tokens=usage.output_tokens)
+
+        messages = []
+        searches = []
+        for content in chat_completion.content:
+            if content.text:
+                if prefill:
+                    text_response = prefill + content.text
+                    prefill = None
+                else:
+                    text_response = content.text
 
-                    message = AssistantMessage(text_response)
-                    if searches:
-                        message.searches += searches
-                        searches.clear()
-                    messages.append(message)
+                message = AssistantMessage(text_response)
+                if searches:
+                    message.searches += searches
+                    searches.clear()
+                messages.append(message)
 
-                if content.type == 'server_tool_use' and content.name == 'web_search':
-                    results = []
-                    for result in chat_completion.content:
-                        if result.type == 'web_search_tool_result' and result.tool_use_id == content.id:
-                            for result_content in result.content:
-                                results.append(result_content['url'])
-                    searches.append((content.input['query'], results))
+            if content.type == 'server_tool_use' and content.name == 'web_search':
+                results = []
+                for result in chat_completion.content:
+                    if result.type == 'web_search_tool_result' and result.tool_use_id == content.id:
+                        for result_content in result.content:
+                            results.append(result_content['url'])
+                searches.append((content.input['query'], results))
 
-            return messages
+        return messages
 
-        except Exception as e:
-            print("Error: " + str(e))
-            return [AssistantMessage("Error querying the LLM: " + str(e))]
+    def is_batching(self):
+        return self.batcher.get() is not None
 
-    def _do_request(self, **kwargs):
+    def _do_request(self, on_partial=None, **kwargs):
         batcher = self.batcher.get()
         if batcher is not None:
+            from anthropic.types.message_create_params import MessageCreateParamsNonStreaming
             return batcher(MessageCreateParamsNonStreaming(**kwargs))
+        elif on_partial is not None:
+            return self._do_stream_request(on_partial, **kwargs)
         else:
             return self.client.messages.create(**kwargs)
 
+    async def _do_stream_request(self, on_partial, **kwargs):
+        async with self.client.messages.stream(**kwargs) as stream:
+            text = ''
+            async for chunk in stream.text_stream:
+                text += chunk
+                on_partial(text)
+
+            return await stream.get_final_message()
+
     async def batch(self, *calls):
         """Like asyncio.gather, but any queries are pooled together into a
-        batch.  Returns a list of results when the batch is completed."""
+        batch.  Returns a list of results when the batch is completed.
+
+        If this is called as part of a batch job, the batch is recorded so
+        that it can be picked up again after a restart, and it is not
+        cancelled if this call is."""
 
         if len(calls) == 0:
             return []
 
+        from anthropic.types.messages.batch_create_params import Request
+
         def collect_request(custom_id, coro):
             # Triggered when a request has been made
             request_fut = asyncio.Future()
@@ -319,29 +769,50 @@ class AnthropicModel(Model):
 
             tasks.append(task)
 
-        batch = await self.client.messages.batches.create(requests=requests)
-        batch_id = batch.id
-        print(f"Initiated batch {batch_id}")
+        job = batches.current_job.get()
+        custom_ids = [request["custom_id"] for request in requests]
+        digests = [batches.request_digest(request["params"]) for request in requests]
+        batch_id = job.claim_batch(self.model_name, custom_ids, digests) if job else None
+
+        if batch_id is not None:
+            print(f"Resuming batch {batch_id}")
+            batch = await self.batches.retrieve(batch_id)
+        else:
+            batch = await self.batches.create(requests=requests)
+            batch_id = batch.id
+            print(f"Initiated batch {batch_id}")
+            if job:
+                job.record_batch(batch_id, self.model_name, custom_ids, digests)
 
         delay = BATCH_CHECK_DELAY
         try:
             while batch.processing_status != 'ended':
                 await asyncio.sleep(delay)
-                delay *= BATCH_CHECK_BACKOFF
-                batch = await self.client.messages.batches.retrieve(batch_id)
+                delay = min(delay * BATCH_CHECK_BACKOFF, BATCH_CHECK_MAX_DELAY)
+                batch = await self.batches.retrieve(batch_id)
 
         finally:
-            if batch.processing_status not in ('ended', 'canceling'):
+            # A batch belonging to a job is left running, so it can be
+            # resumed if we are being cancelled because of a shutdown
+            if batch.processing_status not in ('ended', 'canceling') and not job:
                 print(f"Cancelling batch {batch_id}")
-                await self.client.messages.batches.cancel(batch_id)
+                await self.batches.cancel(batch_id)
 
-        async for response in await self.client.messages.batches.results(batch_id):
-            result_futs[response.custom_id].set_result(response.result.message)
+        async for response in await self.batches.results(batch_id):
+            result = response.result
+            if result.type == 'succeeded':
+                result_futs[response.custom_id].set_result(result.message)
+            else:
+                # Will be retried outside of the batch
+                error = ModelError(f"Batch request {response.custom_id} {result.type}", retryable=True)
+                result_futs[response.custom_id].set_exception(error)
 
         return await asyncio.gather(*tasks)
 
 
 class OpenAIModel(Model):
+    provider = 'openai'
+
     def __init__(self, model_name: str, system_prompt: str = "", temperature: float = 0.0, max_tokens: int = 4000, logger=None):
         if model_name == "gpt-4o":
             model_name = "gpt-4o-2024-11-20" # $2.5/$10
@@ -355,7 +826,9 @@ class OpenAIModel(Model):
             model_name = "gpt-4o-mini-2024-07-18"  # Default to GPT-4o Mini
             print("Invalid model specified. Defaulting to GPT-4o Mini.")
         super().__init__(model_name, system_prompt, temperature, max_tokens, logger)
-        self.client = AsyncOpenAI()
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+        http_client = DefaultAsyncHttpxClient(event_hooks=ratelimit.httpx_event_hooks(self.provider))
+        self.client = AsyncOpenAI(http_client=http_client, max_retries=0)
 
     def encode_message(self, message):
         encoded = {"role": message.role.value}
@@ -369,28 +842,26 @@ class OpenAIModel(Model):
             encoded["content"] = message.content
         return encoded
 
-    async def chat_completion(self, messages=[], model='gpt-4o-mini-2024-07-18', temperature=0.0, max_tokens=1024, system_prompt="", return_type=str):
+    async def chat_completion(self, messages=[], model='gpt-4o-mini-2024-07-18', temperature=0.0, max_tokens=1024, system_prompt="", return_type=str, on_partial=None):
         messages = [self.encode_message(message) for message in messages if message.role != Role.SYSTEM]
         if system_prompt:
             messages.insert(0, {"role": "system", "content": system_prompt})
 
-        try:
-            chat_completion = await self.client.chat.completions.create(
-                messages=messages,
-                model=model,
-                temperature=temperature,
-                max_tokens=max_tokens
-            )
-
-            text_response = chat_completion.choices[0].message.content
-            return [AssistantMessage(text_response)]
-
-        except Exception as e:
-            print("Error: " + str(e))
-            return [AssistantMessage("Error querying the LLM: " + str(e))]
+        text_response, usage = await _openai_chat_completion(
+            self.client,
+            on_partial=on_partial,
+            messages=messages,
+            model=model,
+            temperature=temperature,
+            max_tokens=max_tokens
+        )
+        self.record_usage(**_openai_usage(usage))
+        return [AssistantMessage(text_response)]
 
 
 class OpenRouterModel(Model):
+    provider = 'openrouter'
+
     def __init__(self, model_name: str, system_prompt: str = "", temperature: float = 0.0, max_tokens: int = 4000, logger=None):
         if model_name == "openrouter-llama-3.1":
             model_name = "meta-llama/llama-3.1-405b-instruct" # free
@@ -403,32 +874,35 @@ class OpenRouterModel(Model):
             print("Invalid model specified. Defaulting to meta-llama/llama-3.1-405b-instruct.")
         super().__init__(model_name, system_prompt, temperature, max_tokens, logger)
         OR_API_KEY = os.getenv('OPENROUTER_API_KEY')
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+        http_client = DefaultAsyncHttpxClient(event_hooks=ratelimit.httpx_event_hooks(self.provider))
         self.client = AsyncOpenAI(
             base_url="https://openrouter.ai/api/v1",
-            api_key=OR_API_KEY
+            api_key=OR_API_KEY,
+            http_client=http_client,
+            max_retries=0,
         )
 
-    async def chat_completion(self, messages=[], model='meta-llama/llama-3.1-405b-instruct', temperature=0.0, max_tokens=1024, system_prompt="", return_type=str):
+    async def chat_completion(self, messages=[], model='meta-llama/llama-3.1-405b-instruct', temperature=0.0, max_tokens=1024, system_prompt="", return_type=str, on_partial=None):
         messages = [{"role": message.role.value, "content": message.content} for message in messages if message.role != Role.SYSTEM]
         if system_prompt:
             messages.insert(0, {"role": "system", "content": system_prompt})
 
-        try:
-            chat_completion = await self.client.chat.completions.create(
-                messages=messages,
-                model=model,
-                temperature=temperature,
-                max_tokens=max_tokens
-            )
-            text_response = chat_completion.choices[0].message.content
-            return [AssistantMessage(text_response)]
-
-        except Exception as e:
-            print("Error: " + str(e))
-            return [AssistantMessage("Error querying the LLM: " + str(e))]
+        text_response, usage = await _openai_chat_completion(
+            self.client,
+            on_partial=on_partial,
+            messages=messages,
+            model=model,
+            temperature=temperature,
+            max_tokens=max_tokens
+        )
+        self.record_usage(**_openai_usage(usage))
+        return [AssistantMessage(text_response)]
 
 
 class GeminiModel(Model):
+    provider = 'gemini'
+
     def __init__(self, model_name: str, system_prompt: str = "You are a helpful assistant.", temperature: float = 0.0, max_tokens: int = 4000, logger=None):
         import google.generativeai as genai
         if model_name == "gemini-2.0-flash":
@@ -445,9 +919,17 @@ class GeminiModel(Model):
         super().__init__(model_name, system_prompt, temperature, max_tokens, logger)
         GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
         genai.configure(api_key=GEMINI_API_KEY)
+        self.encoded_cache = EncodedMessageCache()
+        self.content_cache = EncodedMessageCache()
+
+        # (model, generation config, system prompt hash) -> (client, cached_content)
+        self.clients = OrderedDict()
+        self.context_cache_unsupported = set()
 
     async def encode_parts(self, message):
-        import google.generativeai as genai
+        parts = self.encoded_cache.get(message)
+        if parts is not None:
+            return parts
 
         parts = []
         if message.content:
@@ -460,74 +942,159 @@ class GeminiModel(Model):
                 "data": data.decode("ascii"),
             })
 
+        self.encoded_cache.put(message, parts)
         return parts
 
     async def encode_message(self, message):
-        return {
+        from google.generativeai.types import content_types
+
+        content = self.content_cache.get(message)
+        if content is not None:
+            return content
+
+        parts = await self.encode_parts(message)
+        content = content_types.to_content({
             "role": "model" if message.role == Role.ASSISTANT else "user",
-            "parts": await self.encode_parts(message),
-        }
+            "parts": parts,
+        })
+        self.content_cache.put(message, content, size=estimate_size(parts))
+        return content
+
+    async def encode_history(self, messages):
+        """Encodes the given messages as chat history.  Messages that were
+        sent before are taken from the content cache."""
+
+        messages = [message for message in messages if message.role != Role.SYSTEM and (message.content or message.attachments)]
+        return [await self.encode_message(message) for message in messages]
 
-    async def chat_completion(self, messages=[], model='gemini-2.0-flash-exp', temperature=0.0, max_tokens=1024, system_prompt="", return_type=str):
+    async def get_client(self, model, generation_config, system_prompt):
+        """Returns a client for the given configuration, reusing a previously
+        created one if possible."""
         import google.generativeai as genai
-        history = [await self.encode_message(message) for message in messages[:-1] if message.role != Role.SYSTEM and (message.content or message.attachments)]
 
-        # Need to recreate the model with the system prompt as the system instruction
-        client = genai.GenerativeModel(
-            model_name=model,
-            generation_config={
-                "temperature": temperature,
-                "top_p": 0.95,
-                "top_k": 40,
-                "max_output_tokens": max_tokens,
-                "response_mime_type": "text/plain" if return_type is str or "thinking" in model else "application/json",
-            },
-            system_instruction=system_prompt
-        )
+        prompt_hash = hashlib.sha256(system_prompt.encode('utf-8')).hexdigest()
+        key = (model, tuple(sorted(generation_config.items())), prompt_hash)
 
-        try:
-            chat_session = client.start_chat(history=history)
-            response = await chat_session.send_message_async(await self.encode_parts(messages[-1]))
-
-            if len(response.parts) <= 1:
-                return [AssistantMessage(response.text)]
-
-            if return_type is dict or return_type is list:
-                # Identify which part is JSON, the rest must be thought
-                thoughts = []
-                content = None
-                for part in response.parts:
-                    text = part.text.strip()
-                    if text[0] in '{[`':
-                        content = text
-                    else:
-                        thoughts.append(text)
+        entry = self.clients.get(key)
+        if entry is not None:
+            client, cached_content = entry
+            if cached_content is None or cached_content.expire_time > datetime.now(tz=timezone.utc) + timedelta(minutes=1):
+                self.clients.move_to_end(key)
+                return client
 
-                if not content:
-                    return "No JSON found in LLM response."
+            # The context cache is about to expire, make a new one
+            del self.clients[key]
 
-                thought = '\n'.join(thoughts).strip()
-                return [AssistantMessage(content, thought=thought)]
+        cached_content = None
+        if estimate_tokens(system_prompt) >= GEMINI_CONTEXT_CACHE_MIN_TOKENS and model not in self.context_cache_unsupported:
+            cached_content = await self.create_context_cache(model, system_prompt)
 
-            if len(response.parts) > 1:
-                # Assume the first part is thoughts, the rest content
-                content = ''.join(part.text for part in response.parts[1:] if "text" in part)
-                return [AssistantMessage(content, thought=response.parts[0].text)]
-            else:
-                return [AssistantMessage(response.parts[0].text)]
+        if cached_content is not None:
+            client = genai.GenerativeModel.from_cached_content(cached_content, generation_config=generation_config)
+        else:
+            client = genai.GenerativeModel(
+                model_name=model,
+                generation_config=generation_config,
+                system_instruction=system_prompt
+            )
+
+        self.clients[key] = (client, cached_content)
+        while len(self.clients) > GEMINI_CLIENT_CACHE_SIZE:
+            self.clients.popitem(last=False)
 
+        return client
+
+    async def create_context_cache(self, model, system_prompt):
+        """Stores the system prompt in a Gemini context cache, so that it does
+        not need to be processed again on every request.  Returns None if
+        this is not possible."""
+        from google.generativeai import caching
+
+        try:
+            cached_content = await asyncio.to_thread(
+                caching.CachedContent.create,
+                model=model if model.startswith('models/') else f'models/{model}',
+                system_instruction=system_prompt,
+                ttl=GEMINI_CONTEXT_CACHE_TTL)
         except Exception as e:
-            print("Error: " + str(e))
-            return [AssistantMessage("Error querying the LLM: " + str(e))]
+            print(f"Not using context cache for {model}: {e}")
+
+            # Only give up on the model if it can't cache at all, not if eg.
+            # the prompt turned out to be too short this time
+            if getattr(e, 'code', None) == 404 or 'support' in str(e).lower():
+                self.context_cache_unsupported.add(model)
+            return None
+
+        print(f"Created context cache {cached_content.name} for {model}")
+        return cached_content
+
+    async def chat_completion(self, messages=[], model='gemini-2.0-flash-exp', temperature=0.0, max_tokens=1024, system_prompt="", return_type=str, on_partial=None):
+        generation_config = {
+            "temperature": temperature,
+            "top_p": 0.95,
+            "top_k": 40,
+            "max_output_tokens": max_tokens,
+            "response_mime_type": "text/plain" if return_type is str or "thinking" in model else "application/json",
+        }
+
+        history = await self.encode_history(messages[:-1])
+        client = await self.get_client(model, generation_config, system_prompt)
+        chat_session = client.start_chat(history=history)
+        parts = await self.encode_parts(messages[-1])
+        if on_partial is not None:
+            response = await chat_session.send_message_async(parts, stream=True)
+            text = ''
+            async for chunk in response:
+                text += ''.join(part.text for part in chunk.parts if "text" in part)
+                on_partial(text)
+            await response.resolve()
+        else:
+            response = await chat_session.send_message_async(parts)
+
+        usage = getattr(response, 'usage_metadata', None)
+        if usage is not None:
+            read_tokens = getattr(usage, 'cached_content_token_count', 0) or 0
+            self.record_usage(read_tokens=read_tokens, uncached_tokens=usage.prompt_token_count - read_tokens, output_tokens=usage.candidates_token_count)
+
+        if len(response.parts) <= 1:
+            return [AssistantMessage(response.text)]
+
+        if return_type is dict or return_type is list:
+            # Identify which part is JSON, the rest must be thought
+            thoughts = []
+            content = None
+            for part in response.parts:
+                text = part.text.strip()
+                if text[0] in '{[`':
+                    content = text
+                else:
+                    thoughts.append(text)
+
+            if not content:
+                return []
+
+            thought = '\n'.join(thoughts).strip()
+            return [AssistantMessage(content, thought=thought)]
+
+        if len(response.parts) > 1:
+            # Assume the first part is thoughts, the rest content
+            content = ''.join(part.text for part in response.parts[1:] if "text" in part)
+            return [AssistantMessage(content, thought=response.parts[0].text)]
+        else:
+            return [AssistantMessage(response.parts[0].text)]
 
 
 class DeepSeekModel(Model):
+    provider = 'deepseek'
+
     def __init__(self, model_name: str, system_prompt: str = "", temperature: float = 0.0, max_tokens: int = 4000, logger=None):
         model_name = "deepseek-chat"  # $0.14 / 1M tokens Input, $0.28/1M tokens Output
         super().__init__(model_name, system_prompt, temperature, max_tokens, logger)
         DEEPSEEK_API_KEY = os.getenv('DEEPSEEK_API_KEY')
         print(f"Key: {DEEPSEEK_API_KEY}")
-        self.client = AsyncOpenAI(api_key=DEEPSEEK_API_KEY, base_url="https://api.deepseek.com")
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+        http_client = DefaultAsyncHttpxClient(event_hooks=ratelimit.httpx_event_hooks(self.provider))
+        self.client = AsyncOpenAI(api_key=DEEPSEEK_API_KEY, base_url="https://api.deepseek.com", http_client=http_client, max_retries=0)
 
     def encode_message(self, message):
         encoded = {"role": message.role.value}
@@ -541,38 +1108,229 @@ class DeepSeekModel(Model):
             encoded["content"] = message.content
         return encoded
 
-    async def chat_completion(self, messages=[], model='deepseek-chat', temperature=0.0, max_tokens=1024, system_prompt=""):
+    async def chat_completion(self, messages=[], model='deepseek-chat', temperature=0.0, max_tokens=1024, system_prompt="", return_type=str, on_partial=None):
         messages = [self.encode_message(message) for message in messages if message.role != Role.SYSTEM]
         if system_prompt:
             messages.insert(0, {"role": "system", "content": system_prompt})
 
-        try:
-            chat_completion = await self.client.chat.completions.create(
-                messages=messages,
-                model=model,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                stream=False
-            )
+        text_response, usage = await _openai_chat_completion(
+            self.client,
+            on_partial=on_partial,
+            messages=messages,
+            model=model,
+            temperature=temperature,
+            max_tokens=max_tokens
+        )
+        self.record_usage(**_openai_usage(usage))
+        return [AssistantMessage(text_response)]
 
-            text_response = chat_completion.choices[0].message.content
-            return [AssistantMessage(text_response)]
 
-        except Exception as e:
-            print("Error: " + str(e))
-            return [AssistantMessage("Error querying the LLM: " + str(e))]
+class FakeModel(Model):
+    """Generates responses locally without any network access, for testing.
+    Responses are taken in turn from the script if one is given, or else
+    generated from FAKE_RESPONSE_TEMPLATES.  The latency before the first
+    token, the fraction of requests that fail and the rate at which tokens
+    are generated can be configured, and default to the $FAKE_MODEL_LATENCY,
+    $FAKE_MODEL_ERROR_RATE and $FAKE_MODEL_TOKEN_RATE environment variables.
+    A script can be given as a JSON list in the file named by
+    $FAKE_MODEL_SCRIPT.  Errors are drawn from a seeded random generator,
+    so runs are repeatable."""
+
+    provider = 'fake'
+
+    def __init__(self, model_name: str = "fake", system_prompt: str = "", temperature: float = 0.0, max_tokens: int = 4000, logger=None, *, script=None, latency=None, error_rate=None, token_rate=None, seed=0):
+        super().__init__(model_name, system_prompt, temperature, max_tokens, logger)
+
+        if script is None and os.environ.get('FAKE_MODEL_SCRIPT'):
+            with open(os.environ['FAKE_MODEL_SCRIPT'], 'r') as fh:
+                script = json.load(fh)
+
+        self.script = [item if isinstance(item, str) else json.dumps(item) for item in script or ()]
+        self.latency = latency if latency is not None else float(os.environ.get('FAKE_MODEL_LATENCY', 0))
+        self.error_rate = error_rate if error_rate is not None else float(os.environ.get('FAKE_MODEL_ERROR_RATE', 0))
+        self.token_rate = token_rate if token_rate is not None else float(os.environ.get('FAKE_MODEL_TOKEN_RATE', 0))
+        self.random = random.Random(seed)
+        self.count = 0
+
+    def make_response(self, messages, return_type):
+        """Returns the text of the next response."""
+
+        self.count += 1
+        if self.script:
+            return self.script[(self.count - 1) % len(self.script)]
+
+        template = string.Template(FAKE_RESPONSE_TEMPLATES.get(return_type, FAKE_RESPONSE_TEMPLATES[str]))
+        content = messages[-1].content if messages else ''
+        if return_type is not str:
+            # Escape it so that it can go inside a JSON string
+            content = json.dumps(content)[1:-1]
+        return template.safe_substitute(message=content, count=self.count)
+
+    async def chat_completion(self, messages=[], model='fake', temperature=0.0, max_tokens=1024, system_prompt="", return_type=str, on_partial=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if self.error_rate and self.random.random() < self.error_rate:
+            raise ModelError("Simulated error from fake model", status=503, retryable=True)
+
+        text = self.make_response(messages, return_type)
+        self.record_usage(uncached_tokens=sum(message.estimate_tokens() for message in messages), output_tokens=len(text) // CHARS_PER_TOKEN)
+
+        if self.token_rate:
+            # Generate the text one token at a time
+            for i in range(CHARS_PER_TOKEN, len(text) + CHARS_PER_TOKEN, CHARS_PER_TOKEN):
+                await asyncio.sleep(1.0 / self.token_rate)
+                if on_partial is not None:
+                    on_partial(text[:i])
+
+        elif on_partial is not None:
+            on_partial(text)
+
+        return [AssistantMessage(text)]
+
+
+class CompositeModel(Model):
+    """Wraps several models, querying the first one and falling back to the
+    next if it fails.  If the first model takes unusually long to respond,
+    a hedged request is sent to the next model as well, and whichever gives
+    a valid response first wins."""
+
+    def __init__(self, models, logger=None):
+        super().__init__('|'.join(model.model_name for model in models), models[0].system_prompt, models[0].temperature, models[0].max_tokens, logger)
+        self.models = models
+        self.latencies = {id(model): deque(maxlen=HEDGE_LATENCY_SAMPLES) for model in models}
+        self.batching = ContextVar('batching', default=False)
+
+    def hedge_delay(self, model):
+        """Returns how long to wait for the given model before hedging."""
+
+        samples = sorted(self.latencies[id(model)])
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+
+        return samples[min(int(len(samples) * HEDGE_LATENCY_PERCENTILE), len(samples) - 1)]
+
+    async def batch(self, *calls):
+        # Hedging would take requests out of the batch, so only fall back
+        # while the calls are being batched
+        async def wrapper(coro):
+            token = self.batching.set(True)
+            try:
+                return await coro
+            finally:
+                self.batching.reset(token)
+
+        return await self.models[0].batch(*(wrapper(call) for call in calls))
+
+    async def query(self, messages: List[Message], system_prompt=None, validate_func=None, return_type=str, on_partial=None) -> str:
+        if self.batching.get():
+            return await self._query_fallback(messages, system_prompt, validate_func, return_type, on_partial)
+
+        # Only one of the racing requests may stream into on_partial, the
+        # first one to produce output claims it
+        streaming = []
+        def claim_partial(index):
+            def callback(text):
+                if not streaming:
+                    streaming.append(index)
+                if streaming[0] == index:
+                    on_partial(text)
+            return callback
+
+        pending = {}
+        errors = []
+        next_index = 0
+
+        def start_next():
+            nonlocal next_index
+            index = next_index
+            next_index += 1
+            model = self.models[index]
+            # Each request extends its own copy of the message list
+            copy = list(messages)
+            coro = self._timed_query(model, copy, system_prompt, validate_func, return_type, claim_partial(index) if on_partial else None)
+            pending[asyncio.ensure_future(coro)] = (model, copy)
+
+        start_next()
+        try:
+            while pending:
+                timeout = None
+                if next_index < len(self.models):
+                    timeout = self.hedge_delay(self.models[next_index - 1])
+
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self.logger.warning(f"No response from {self.models[next_index - 1].model_name} after {timeout:.1f} seconds, hedging with {self.models[next_index].model_name}")
+                    start_next()
+                    continue
+
+                for task in done:
+                    model, copy = pending.pop(task)
+                    try:
+                        response = task.result()
+                    except (ModelError, ValueError) as ex:
+                        self.logger.warning(f"Query to {model.model_name} failed: {ex}")
+                        errors.append(ex)
+                        continue
+
+                    messages += copy[len(messages):]
+                    return response
+
+                # Everything failed so far, move on to the next model
+                if not pending and next_index < len(self.models):
+                    start_next()
+
+        finally:
+            for task in pending:
+                task.cancel()
+
+        raise errors[-1]
+
+    async def _query_fallback(self, messages, system_prompt, validate_func, return_type, on_partial):
+        for model in self.models:
+            try:
+                return await self._timed_query(model, messages, system_prompt, validate_func, return_type, on_partial)
+            except (ModelError, ValueError) as ex:
+                self.logger.warning(f"Query to {model.model_name} failed: {ex}")
+                if model is self.models[-1]:
+                    raise
+
+    async def _timed_query(self, model, messages, system_prompt, validate_func, return_type, on_partial):
+        start = time.monotonic()
+        response = await model.query(messages, system_prompt=system_prompt, validate_func=validate_func, return_type=return_type, on_partial=on_partial)
+        self.latencies[id(model)].append(time.monotonic() - start)
+        return response
+
+    async def chat_completion(self, messages=[], model=None, temperature=0.0, max_tokens=1024, system_prompt="", return_type=str, on_partial=None):
+        return await self.models[0].chat_completion(messages, self.models[0].model_name, temperature, max_tokens, system_prompt, return_type, on_partial=on_partial)
+
+
+# Model classes by the prefix of the model names they handle.  The classes
+# import the SDK of their provider only when they are instantiated, so that
+# startup doesn't pay for SDKs that aren't used.  Names not matching any
+# prefix are assumed to be Ollama models.
+providers = {
+    'claude-': AnthropicModel,
+    'gpt-': OpenAIModel,
+    'openrouter-': OpenRouterModel,
+    'gemini-': GeminiModel,
+    'deepseek-': DeepSeekModel,
+    'fake': FakeModel,
+}
+
+
+def register_provider(prefix, cls):
+    """Makes create() use the given Model subclass for names starting with
+    the given prefix."""
+    providers[prefix] = cls
 
 
 def create(model_name):
-    if model_name.startswith('claude-'):
-        return AnthropicModel(model_name)
-    elif model_name.startswith('gpt-'):
-        return OpenAIModel(model_name)
-    elif model_name.startswith('openrouter-'):
-        return OpenRouterModel(model_name)
-    elif model_name.startswith('gemini-'):
-        return GeminiModel(model_name)
-    elif model_name.startswith('deepseek-'):
-        return DeepSeekModel(model_name)
-    else:
-        return OllamaModel(model_name)
+    if '|' in model_name:
+        return CompositeModel([create(name.strip()) for name in model_name.split('|')])
+
+    for prefix, cls in providers.items():
+        if model_name.startswith(prefix):
+            return cls(model_name)
+
+    return OllamaModel(model_name)
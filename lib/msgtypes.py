@@ -3,9 +3,14 @@ import json
 import aiohttp
 from datetime import datetime, timezone
 
+from .util import estimate_tokens, estimate_tokens_for_length
+
 
 http_session = None
 
+# Rough number of tokens taken up by an image attachment
+ATTACHMENT_TOKENS = 1500
+
 class Role(Enum):
     SYSTEM = 'system'
     USER = 'user'
@@ -50,25 +55,136 @@ class Attachment:
             return data
 
 
+class SummaryInfo:
+    """Describes which part of the conversation a summary message covers.
+    Level 0 summaries summarise messages, level 1 summaries merge level 0
+    summaries, and so on."""
+
+    def __init__(self, level=0, count=0, start=None, end=None):
+        self.level = level
+        # Number of original messages covered
+        self.count = count
+        # Timestamps of the first and last message covered
+        self.start = start
+        self.end = end
+
+    @staticmethod
+    def merge(infos, level):
+        infos = [info for info in infos if info is not None]
+        starts = [info.start for info in infos if info.start]
+        ends = [info.end for info in infos if info.end]
+        return SummaryInfo(level, sum(info.count for info in infos),
+                           starts[0] if starts else None,
+                           ends[-1] if ends else None)
+
+    def to_dict(self):
+        obj = {"level": self.level, "count": self.count}
+        if self.start:
+            obj["start"] = int(self.start.timestamp())
+        if self.end:
+            obj["end"] = int(self.end.timestamp())
+        return obj
+
+    @staticmethod
+    def from_dict(obj):
+        start = obj.get("start")
+        end = obj.get("end")
+        return SummaryInfo(obj.get("level", 0), obj.get("count", 0),
+                           datetime.fromtimestamp(start, tz=timezone.utc) if start else None,
+                           datetime.fromtimestamp(end, tz=timezone.utc) if end else None)
+
+
+class LazyContent:
+    """Content of a message that hasn't been loaded from disk yet."""
+
+    __slots__ = 'load', 'is_summary'
+
+    def __init__(self, load, is_summary=False):
+        self.load = load
+        self.is_summary = is_summary
+
+
 class Message:
-    __slots__ = 'content', 'id', 'attachments', 'timestamp', 'thought', 'searches'
+    __slots__ = '_content', 'id', '_attachments', 'timestamp', '_thought', 'searches', 'version', '_token_estimates', '_reduced', 'summary', '_lazy'
 
     def __init__(self, content: str, id=None, timestamp=None, thought=None):
         assert hasattr(self, 'role')
-        self.content = content
+        # Bumped whenever the content or attachments change, so that data
+        # derived from them can be cached
+        self.version = 0
+        self._lazy = None
+        self._content = content
         self.id = id
-        self.attachments = []
+        self._attachments = []
         self.timestamp = timestamp
-        self.thought = thought
+        self._thought = thought
         self.searches = []
+        self._token_estimates = None
+        self._reduced = None
+        # SummaryInfo, for summaries created since they started being recorded
+        self.summary = None
+
+    def set_lazy_content(self, load, is_summary=False, length=None):
+        """Makes the content and thought of this message be loaded on first
+        access, by calling load(), which should return both.  is_summary
+        says whether the content is that of a summary, and length, if given,
+        is the length of the content, so that its tokens can be estimated
+        without loading it."""
+
+        self._lazy = LazyContent(load, is_summary)
+        self._content = None
+        self._thought = None
+
+        if length is not None:
+            tokens = estimate_tokens_for_length(length) + ATTACHMENT_TOKENS * len(self.attachments)
+            self._token_estimates = [self.version, tokens, None]
+
+    def _load_content(self):
+        lazy, self._lazy = self._lazy, None
+        self._content, self._thought = lazy.load()
+
+    @property
+    def content(self):
+        if self._lazy is not None:
+            self._load_content()
+        return self._content
+
+    @content.setter
+    def content(self, content):
+        if self._lazy is not None:
+            self._load_content()
+        self._content = content
+        self.version += 1
+
+    @property
+    def thought(self):
+        if self._lazy is not None:
+            self._load_content()
+        return self._thought
+
+    @thought.setter
+    def thought(self, thought):
+        if self._lazy is not None:
+            self._load_content()
+        self._thought = thought
+
+    @property
+    def attachments(self):
+        return self._attachments
+
+    @attachments.setter
+    def attachments(self, attachments):
+        self._attachments = attachments
+        self.version += 1
 
     def attach(self, url, content_type):
-        self.attachments.append(Attachment(url, content_type))
+        self._attachments.append(Attachment(url, content_type))
+        self.version += 1
 
     def parse_json(self):
         return json.loads(self.content, strict=False)
 
-    def dump(self, file):
+    def to_dict(self):
         obj = {"role": self.role.value, "content": self.content}
         if self.id is not None:
             obj["id"] = self.id
@@ -78,12 +194,33 @@ class Message:
             obj["attachments"] = [{"url": attach.url, "content_type": attach.content_type} for attach in self.attachments]
         if self.thought:
             obj["thought"] = self.thought
+        if self.summary:
+            obj["summary"] = self.summary.to_dict()
+        return obj
 
-        file.write(json.dumps(obj) + "\n")
+    def dump(self, file):
+        file.write(json.dumps(self.to_dict()) + "\n")
 
     def is_summary(self):
         return False
-    
+
+    def estimate_tokens(self, reduced=False):
+        """Returns a rough estimate of the number of tokens this message (or
+        its reduced form) takes up in the context.  Cached until the message
+        is changed."""
+
+        estimates = self._token_estimates
+        if estimates is None or estimates[0] != self.version:
+            estimates = [self.version, None, None]
+            self._token_estimates = estimates
+
+        index = 2 if reduced else 1
+        if estimates[index] is None:
+            message = self.reduce() if reduced else self
+            estimates[index] = estimate_tokens(message.content) + ATTACHMENT_TOKENS * len(message.attachments)
+
+        return estimates[index]
+
     def __str__(self):
         return f'{self.role.value}: {self.content}'
     
@@ -91,6 +228,26 @@ class Message:
         return str(self)
 
     def reduce(self):
+        """Returns the form in which this message is sent when it is further
+        back in the context.  Cached until the message is changed."""
+
+        reduced = self._reduced
+        if reduced is None or reduced[0] != self.version:
+            message = self._reduce()
+            # Don't keep a reference to ourselves
+            reduced = (self.version, None if message is self else message)
+            self._reduced = reduced
+
+        return reduced[1] or self
+
+    def is_reduced(self):
+        """Returns whether this message is already sent the same way as when
+        it is further back in the context."""
+
+        reduced = self.reduce()
+        return reduced is self or (reduced.content == self.content and reduced.attachments == self.attachments)
+
+    def _reduce(self):
         return self
 
 
@@ -98,9 +255,12 @@ class AssistantMessage(Message):
     role = Role.ASSISTANT
 
     def is_summary(self):
+        # Avoid loading the content just to check this
+        if self._lazy is not None:
+            return self._lazy.is_summary
         return self.content.startswith("~~~")
 
-    def reduce(self):
+    def _reduce(self):
         try:
             content = self.parse_json()
             content.pop("impression", None)
@@ -118,10 +278,18 @@ class SystemMessage(Message):
     role = Role.SYSTEM
 
 
+class ContextMessage(Message):
+    """Volatile context, such as plugin state, that is inserted near the end
+    of a query instead of into the system prompt, so that everything before
+    it stays the same from turn to turn and can be cached by the provider.
+    Never stored in the session."""
+    role = Role.USER
+
+
 class UserMessage(Message):
     role = Role.USER
 
-    def reduce(self):
+    def _reduce(self):
         if not self.attachments:
             return self
 
@@ -129,7 +297,10 @@ class UserMessage(Message):
 
 
 def parse_message(string):
-    obj = json.loads(string)
+    return message_from_dict(json.loads(string))
+
+
+def message_from_dict(obj):
     msg_id = obj.get("id")
 
     if obj["role"] == "system":
@@ -150,6 +321,9 @@ def parse_message(string):
     if obj.get("timestamp"):
         msg.timestamp = datetime.fromtimestamp(obj["timestamp"], tz=timezone.utc)
 
+    if obj.get("summary"):
+        msg.summary = SummaryInfo.from_dict(obj["summary"])
+
     for attach in obj.get("attachments", ()):
         msg.attachments.append(Attachment(attach["url"], attach["content_type"]))
 
@@ -3,10 +3,8 @@ import asyncio
 import inspect
 from datetime import datetime
 
-import discord
-from discord.ext import commands
-
 from .msgtypes import Channel
+from .batches import BatchJob, current_job
 
 
 HOOK_NAMES = (
@@ -43,6 +41,7 @@ class Plugin:
         self._discord_commands = []
         self._static_system_prompts = []
         self._dynamic_system_prompts = []
+        self._system_prompt_version = 0
         self._scheduled_tasks = set()
 
         for name in dir(self):
@@ -115,6 +114,39 @@ class Plugin:
         self._scheduled_tasks.add(task)
         return task
 
+    async def run_batch_job(self, continuation, *args):
+        """Runs the given batch continuation with the given arguments, which
+        must be JSON serializable.  Any batches it submits are recorded, so
+        that the job can be resumed if the bot is restarted before it is
+        finished."""
+
+        assert getattr(continuation, '_batch_continuation', False)
+
+        name = type(self).__module__.rpartition('.')[2]
+        key = '-'.join([self.assistant.id, name, continuation.__name__] + [str(arg) for arg in args])
+        job = BatchJob.load(key) or BatchJob(key, self.assistant.id, name, continuation.__name__, args)
+
+        token = current_job.set(job)
+        try:
+            result = await continuation(*args)
+        except asyncio.CancelledError:
+            # Probably shutting down, keep the record so we can resume
+            raise
+        except Exception:
+            job.remove()
+            raise
+        finally:
+            current_job.reset(token)
+
+        job.remove()
+        return result
+
+    def system_prompt_changed(self):
+        """Should be called whenever the versioned dynamic system prompts of
+        this plugin would return something different, since they are
+        otherwise reused."""
+        self._system_prompt_version += 1
+
     def send_message(self, message, *, channel=Channel.CHAT):
         """If this Assistant is running in a Discord bot, sends a message to
         the specified channel, if that channel is configured.
@@ -168,11 +200,28 @@ def discord_command(*args, **kwargs):
     return decorator
 
 
+def batch_continuation(func):
+    """Decorator used to mark a method that may be run via run_batch_job.
+    If it is interrupted by a restart, it is called again with the same
+    arguments, and should then make the same batch queries in the same order
+    so that the batches already submitted can be reused."""
+    func._batch_continuation = True
+    return func
+
+
 def system_prompt(func=None, /, *, dynamic=False):
+    """Decorator used to register a method returning part of the system
+    prompt.  Static prompts are generated once per session.  Dynamic prompts
+    are sent along with the latest messages, and are generated again for
+    every response, or with dynamic='versioned' only after the plugin calls
+    system_prompt_changed()."""
+
+    assert dynamic in (False, True, 'versioned')
+
     def decorator(func):
         assert not inspect.iscoroutinefunction(func)
         if dynamic:
-            func._dynamic_system_prompt = True
+            func._dynamic_system_prompt = dynamic
         else:
             func._static_system_prompt = True
         return func
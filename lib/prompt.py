@@ -0,0 +1,83 @@
+"""Assembles the system prompt and the dynamic plugin context of a session, and
+keeps them until the system message or the prompts of a plugin change, so
+that the plugins don't regenerate their prompts on every turn.  This only
+applies to dynamic prompts declared with dynamic='versioned', whose plugins
+signal that they would change by calling Plugin.system_prompt_changed();
+other dynamic prompts are generated again on every turn."""
+
+
+class PromptCache:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+        # (system message, its version, format prompt, assembled prompt)
+        self.__system_prompt = None
+
+        # Versioned dynamic prompts by plugin and name, along with the
+        # plugin's prompt version
+        self.__fragments = {}
+
+        # (versions of all plugins' prompts, assembled context)
+        self.__context = None
+
+    def __str__(self):
+        if not self.hits and not self.misses:
+            return "not used yet"
+
+        return f"{self.hits} hits, {self.misses} misses ({self.hit_rate:.0%} hit rate)"
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, session):
+        """Returns the system prompt of the given session, and the text of
+        the dynamic prompts of its plugins, or None if there are none."""
+
+        system_message = session.system_message
+        plugins = list(session.assistant.plugins.values())
+        versions = tuple(plugin._system_prompt_version for plugin in plugins)
+        volatile = any(prompt._dynamic_system_prompt != 'versioned'
+                       for plugin in plugins for prompt in plugin._dynamic_system_prompts)
+
+        cached = self.__system_prompt
+        system_valid = cached is not None and cached[0] is system_message and \
+                       cached[1] == system_message.version and cached[2] is session.standard_format_prompt
+        context_valid = not volatile and self.__context is not None and self.__context[0] == versions
+
+        if system_valid and context_valid:
+            self.hits += 1
+            return cached[3], self.__context[1]
+
+        self.misses += 1
+
+        if not system_valid:
+            system_prompt = system_message.content + "\n\n" + session.standard_format_prompt
+            self.__system_prompt = (system_message, system_message.version, session.standard_format_prompt, system_prompt)
+
+        if not context_valid:
+            # Versioned prompts are only generated again if their plugin's
+            # prompts changed
+            prompts = []
+            for plugin in plugins:
+                if not plugin._dynamic_system_prompts:
+                    continue
+
+                fragment = self.__fragments.get(plugin)
+                if fragment is None or fragment[0] != plugin._system_prompt_version:
+                    fragment = (plugin._system_prompt_version, {})
+                    self.__fragments[plugin] = fragment
+
+                for prompt in plugin._dynamic_system_prompts:
+                    if prompt._dynamic_system_prompt != 'versioned':
+                        prompts.append(prompt(session))
+                    else:
+                        if prompt.__name__ not in fragment[1]:
+                            fragment[1][prompt.__name__] = prompt(session)
+                        prompts.append(fragment[1][prompt.__name__])
+
+            self.__context = (versions, '\n\n'.join(prompts) if prompts else None)
+
+        return self.__system_prompt[3], self.__context[1]
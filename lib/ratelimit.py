@@ -0,0 +1,220 @@
+"""Limits the rate and concurrency of requests to each model provider, so that
+requests queue up locally rather than being rejected by the provider.  The
+limits are taken from the rate limit headers in the provider's responses
+where available, or can be configured through the environment, for example
+$ANTHROPIC_MAX_CONCURRENT, $ANTHROPIC_REQUESTS_PER_MINUTE and
+$ANTHROPIC_TOKENS_PER_MINUTE."""
+
+import asyncio
+import os
+import re
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+# Default maximum number of simultaneous requests to a provider
+DEFAULT_MAX_CONCURRENT = 4
+
+# Waits longer than this many seconds are logged
+REPORT_WAIT_TIME = 1.0
+
+
+def parse_reset_time(value):
+    """Parses the time until a rate limit resets, which may be given as a
+    number of seconds, a duration like "6m0s" or "20ms", or a timestamp.
+    Returns the number of seconds, or None if it can't be parsed."""
+
+    if not value:
+        return None
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    match = re.fullmatch(r'(?:(\d+)h)?(?:(\d+)m(?!s))?(?:([\d.]+)s)?(?:([\d.]+)ms)?', value)
+    if match and any(match.groups()):
+        hours, minutes, seconds, millis = (float(group or 0) for group in match.groups())
+        return hours * 3600 + minutes * 60 + seconds + millis / 1000
+
+    try:
+        reset = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        return max(0.0, reset.timestamp() - time.time())
+    except ValueError:
+        return None
+
+
+def _parse_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Allows up to rate units to be taken per minute, refilling at a steady
+    pace.  A rate of None means no limit, unless the provider has told us to
+    back off until a certain time."""
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.available = rate
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.available = min(self.rate, self.available + (now - self.updated) * self.rate / 60.0)
+        self.updated = now
+
+    def delay(self, amount):
+        """Returns how many seconds to wait until amount can be taken."""
+
+        self._refill()
+        delay = self.blocked_until - self.updated
+        if self.rate:
+            # Something bigger than the bucket has to go through eventually
+            amount = min(amount, self.rate)
+            if self.available < amount:
+                delay = max(delay, (amount - self.available) * 60.0 / self.rate)
+        return max(delay, 0.0)
+
+    def take(self, amount):
+        self._refill()
+        if self.rate:
+            self.available -= min(amount, self.rate)
+
+    def update(self, limit=None, remaining=None, reset=None):
+        """Updates the bucket with the limits reported by the provider."""
+
+        self._refill()
+        if limit:
+            if self.rate is None:
+                self.available = limit
+            self.rate = limit
+
+        if remaining is not None:
+            if self.rate:
+                self.available = min(self.available, remaining)
+            if remaining <= 0 and reset:
+                self.blocked_until = self.updated + reset
+
+
+class ProviderLimiter:
+    """Limits the number of simultaneous requests to a provider, as well as
+    the requests and input tokens per minute, and keeps track of how long
+    requests had to wait."""
+
+    def __init__(self, provider, max_concurrent=DEFAULT_MAX_CONCURRENT, requests_per_minute=None, tokens_per_minute=None):
+        self.provider = provider
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+        # Makes sure waiting requests are let through in order
+        self.lock = asyncio.Lock()
+
+        self.queued = 0
+        self.request_count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def __str__(self):
+        if not self.request_count:
+            return "no requests"
+
+        average = self.total_wait / self.request_count
+        return f"{self.request_count} requests, {self.queued} queued, average wait {average:.2f}s, longest wait {self.max_wait:.1f}s"
+
+    @asynccontextmanager
+    async def acquire(self, tokens=0):
+        """Waits until a request using the given number of input tokens may
+        be made, and holds a slot for it until the context is exited.  The
+        context value is the number of seconds spent waiting."""
+
+        start = time.monotonic()
+        self.queued += 1
+        try:
+            await self.semaphore.acquire()
+            try:
+                async with self.lock:
+                    while True:
+                        delay = max(self.requests.delay(1), self.tokens.delay(tokens))
+                        if delay <= 0:
+                            break
+                        await asyncio.sleep(delay)
+
+                    self.requests.take(1)
+                    self.tokens.take(tokens)
+            except:
+                self.semaphore.release()
+                raise
+        finally:
+            self.queued -= 1
+
+        wait = time.monotonic() - start
+        self.request_count += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        if wait > REPORT_WAIT_TIME:
+            print(f"Request to {self.provider} waited {wait:.1f} seconds for the rate limit")
+
+        try:
+            yield wait
+        finally:
+            self.semaphore.release()
+
+    def update_from_headers(self, headers):
+        """Adjusts the limits to the rate limit headers sent by Anthropic or
+        by OpenAI-compatible providers."""
+
+        # Anthropic
+        self.requests.update(_parse_int(headers.get('anthropic-ratelimit-requests-limit')),
+                             _parse_int(headers.get('anthropic-ratelimit-requests-remaining')),
+                             parse_reset_time(headers.get('anthropic-ratelimit-requests-reset')))
+
+        kind = 'input-tokens' if 'anthropic-ratelimit-input-tokens-limit' in headers else 'tokens'
+        self.tokens.update(_parse_int(headers.get(f'anthropic-ratelimit-{kind}-limit')),
+                           _parse_int(headers.get(f'anthropic-ratelimit-{kind}-remaining')),
+                           parse_reset_time(headers.get(f'anthropic-ratelimit-{kind}-reset')))
+
+        # OpenAI and compatible
+        self.requests.update(_parse_int(headers.get('x-ratelimit-limit-requests')),
+                             _parse_int(headers.get('x-ratelimit-remaining-requests')),
+                             parse_reset_time(headers.get('x-ratelimit-reset-requests')))
+        self.tokens.update(_parse_int(headers.get('x-ratelimit-limit-tokens')),
+                           _parse_int(headers.get('x-ratelimit-remaining-tokens')),
+                           parse_reset_time(headers.get('x-ratelimit-reset-tokens')))
+
+
+# Limiters, by provider name
+limiters = {}
+
+
+def get_limiter(provider):
+    """Returns the shared limiter for the given provider, creating it with
+    the limits configured in the environment if necessary."""
+
+    limiter = limiters.get(provider)
+    if limiter is None:
+        prefix = re.sub(r'\W', '_', provider).upper()
+        max_concurrent = int(os.environ.get(f'{prefix}_MAX_CONCURRENT', DEFAULT_MAX_CONCURRENT))
+        rpm = _parse_int(os.environ.get(f'{prefix}_REQUESTS_PER_MINUTE'))
+        tpm = _parse_int(os.environ.get(f'{prefix}_TOKENS_PER_MINUTE'))
+        limiter = ProviderLimiter(provider, max_concurrent, rpm, tpm)
+        limiters[provider] = limiter
+
+    return limiter
+
+
+def httpx_event_hooks(provider):
+    """Returns event hooks for an httpx client that feed the rate limit
+    headers of every response into the limiter of the given provider."""
+
+    limiter = get_limiter(provider)
+
+    async def on_response(response):
+        limiter.update_from_headers(response.headers)
+
+    return {'response': [on_response]}
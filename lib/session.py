@@ -5,8 +5,11 @@ from datetime import datetime, time, timedelta, timezone
 from typing import Optional
 
 from .response import AssistantResponse
-from .msgtypes import Role, Message, SystemMessage, UserMessage, AssistantMessage
-from .util import Condition
+from .msgtypes import Role, Message, SystemMessage, UserMessage, AssistantMessage, ContextMessage, SummaryInfo
+from .util import Condition, estimate_tokens
+from .context import plan_context
+from .prompt import PromptCache
+from . import accounting
 
 # Format prompt comes from session_format_prompt.txt
 with open('session_format_prompt.txt', 'r') as f:
@@ -15,20 +18,55 @@ with open('session_format_prompt.txt', 'r') as f:
 with open('summary_prompt.txt', 'r') as f:
     SUMMARY_PROMPT = f.read()
 
+with open('summary_merge_prompt.txt', 'r') as f:
+    SUMMARY_MERGE_PROMPT = f.read()
+
+# Number of summaries of one level that are merged into one of the next level
+SUMMARY_MERGE_COUNT = 4
+
+# Fraction of the summarisation thresholds at which a summary starts being
+# created in the background
+SPECULATIVE_SUMMARY_FRACTION = 0.8
+
+
+def summary_level(message):
+    # Summaries from before levels were recorded count as level 0
+    return message.summary.level if message.summary else 0
+
 
 class Session:
     def __init__(self, date, assistant, system_prompt=""):
         self.date = date
-        self.messages_file = None
+        # SessionJournal or SessionStore that changes are recorded in, if
+        # the session is writable
+        self.journal = None
         self.message_history = []
+
+        # Messages that have a Discord id, by id, in the order of the history
+        self.messages_by_id = {}
+
+        # Number of messages and estimated tokens since the last summary
+        self.messages_since_summary = 0
+        self.tokens_since_summary = 0
+
         self.last_activity = datetime.now()
         self.assistant = assistant
         self.initial_system_prompt = system_prompt
         if self.initial_system_prompt:
             system_message = SystemMessage(self.initial_system_prompt)
             self.message_history.append(system_message)
+            self.messages_since_summary = 1
 
         self.context_lock = asyncio.Lock()
+        self.context_report = None
+        self.prompt_cache = PromptCache()
+
+        # Summary being created in the background, and the result
+        self.summary_task = None
+        self.ready_summary = None
+
+        # Set by close(), after which summaries are no longer applied
+        self.closed = False
 
         self.standard_format_prompt = FORMAT_PROMPT
 
@@ -56,26 +94,113 @@ class Session:
     def last_message(self):
         return self.message_history[-1]
 
-    def find_message(self, id):
-        assert id is not None
+    @property
+    def has_summary(self):
+        # Only messages after the last summary are counted
+        return self.messages_since_summary < len(self.message_history)
 
-        for message in self.message_history:
-            if message.id == id:
-                return message
+    @property
+    def last_message_with_id(self):
+        return next(reversed(self.messages_by_id.values()), None)
+
+    def set_message_history(self, messages):
+        """Replaces the entire message history, eg. when loading a session."""
+        self.message_history = messages
+        self.messages_by_id = {}
+        self._index_messages(messages)
+        self._recount_since_summary()
+
+    def _index_messages(self, messages):
+        for message in messages:
+            if message.id is not None:
+                self.messages_by_id[message.id] = message
+
+    def _count_since_summary(self, messages):
+        for message in messages:
+            if message.is_summary():
+                self.messages_since_summary = 0
+                self.tokens_since_summary = 0
+            else:
+                self.messages_since_summary += 1
+                # The system prompt is never summarised
+                if message.role != Role.SYSTEM:
+                    self.tokens_since_summary += message.estimate_tokens()
+
+    def _recount_since_summary(self):
+        """Recounts the messages since the last summary, which only needs to
+        look as far back as that summary."""
+
+        history = self.message_history
+        start = len(history)
+        while start > 0 and not history[start - 1].is_summary():
+            start -= 1
+
+        self.messages_since_summary = 0
+        self.tokens_since_summary = 0
+        self._count_since_summary(history[start:])
+
+    def _unindex_messages(self, messages):
+        for message in messages:
+            if message.id is not None and self.messages_by_id.get(message.id) is message:
+                del self.messages_by_id[message.id]
+
+    def _position(self, message):
+        # Edits and deletions are usually of recent messages, so search
+        # from the end
+        history = self.message_history
+        for i in range(len(history) - 1, -1, -1):
+            if history[i] is message:
+                return i
 
         return None
 
+    def find_message(self, id):
+        assert id is not None
+
+        return self.messages_by_id.get(id)
+
     def delete_message(self, id):
         assert id is not None
 
-        for i, message in enumerate(self.message_history):
-            if message.id == id:
-                del self.message_history[i]
-                break
-        else:
+        message = self.messages_by_id.pop(id, None)
+        if message is None:
+            return
+
+        i = self._position(message)
+        if i is None:
+            return
+
+        del self.message_history[i]
+        self._recount_since_summary()
+
+        if self.journal:
+            self.journal.delete(i)
+            self._journal_changed()
+
+    def update_message(self, message: Message):
+        """Saves the changes made to a message in the history."""
+
+        i = self._position(message)
+        if i is None:
             return
 
-        self._rewrite_message_file()
+        self._recount_since_summary()
+
+        if self.journal:
+            self.journal.edit(i, message)
+            self._journal_changed()
+
+    def _journal_changed(self):
+        self.journal.flush()
+        self.journal.maybe_compact(self.message_history)
+
+    async def close(self):
+        """Waits until all changes to the session have been written out, and
+        records its final state in the session manifest."""
+        self.closed = True
+        if self.journal:
+            self.assistant.record_session(self)
+            await self.journal.close()
 
     def push_message(self, message: Message):
         return self.push_messages((message,))
@@ -86,11 +211,14 @@ class Session:
 
         async with self.context_lock:
             self.message_history.extend(messages)
+            self._index_messages(messages)
+            self._count_since_summary(messages)
             for message in messages:
                 if message.timestamp is None:
                     message.timestamp = datetime.now(tz=timezone.utc)
-                message.dump(self.messages_file)
-            self.messages_file.flush()
+            if self.journal:
+                self.journal.append(messages)
+                self.journal.flush()
 
             if any(message.role == Role.USER for message in messages):
                 self.new_user_message.notify_all()
@@ -104,26 +232,86 @@ class Session:
 
         return None
 
-    def should_summarise(self):
-        """Determines if the message history needs summarisation."""
-        # Check if we have more than self.assistant.summarisation_threshold messages
-        # Count how many messages there are since the last summarisation (which started with "~~~")
-        messages_since_last_summary = 0
-        for message in self.message_history[::-1]:
-            if message.is_summary():
-                break
-            messages_since_last_summary += 1
+    def should_summarise(self, fraction=1.0):
+        """Determines if the message history needs summarisation, because
+        there are more messages or more tokens since the last summary
+        (which started with "~~~") than the given fraction of the
+        assistant's thresholds."""
+
         if self.assistant.summarisation_threshold is not None and \
-           messages_since_last_summary > self.assistant.summarisation_threshold:
+           self.messages_since_summary > self.assistant.summarisation_threshold * fraction:
+            return True
+
+        if self.assistant.summarisation_token_threshold is not None and \
+           self.tokens_since_summary > self.assistant.summarisation_token_threshold * fraction:
             return True
 
         return False
 
+    def prepare_summary(self):
+        """Starts creating a summary in the background once the message
+        history nears the summarisation thresholds, so that it's ready by the
+        time they are crossed."""
+
+        if self.summary_task is None and self.ready_summary is None and not self.closed and \
+           self.should_summarise(SPECULATIVE_SUMMARY_FRACTION):
+            self.summary_task = asyncio.create_task(self._prepare_summary())
+
+    async def _prepare_summary(self):
+        try:
+            self.ready_summary = await self.create_summary()
+        except Exception as ex:
+            print(f"Failed to create summary: {ex}")
+        finally:
+            self.summary_task = None
+
+        if self.should_summarise():
+            await self.apply_ready_summary()
+
+    async def apply_ready_summary(self):
+        """Swaps the summary prepared in the background into the message
+        history, unless the session has been closed."""
+
+        async with self.context_lock:
+            self._apply_ready_summary()
+
+    def _apply_ready_summary(self):
+        # Must be called with the context lock held.  The summary is thrown
+        # away if the summarised messages have changed in the meantime.
+        if self.closed:
+            return
+
+        summary, self.ready_summary = self.ready_summary, None
+        if summary is None:
+            return
+
+        start, covered, summary_message = summary
+        end = start + len(covered) - 1
+        current = self.message_history[start - 1:end]
+        if len(current) != len(covered) or \
+           any(message is not other or message.version != version for message, (other, version) in zip(current, covered)):
+            print("Discarding summary, since the summarised messages have changed")
+            self.prepare_summary()
+            return
+
+        # Replace the summarised messages with the summary, keeping the system
+        # prompt, previous summaries and recent messages
+        self._unindex_messages(self.message_history[start:end])
+        self.message_history[start:end] = [summary_message]
+        self._recount_since_summary()
+
+        if self.journal:
+            self.journal.replace_range(start, end, [summary_message])
+            self._journal_changed()
+
     async def create_summary(self):
-        """Creates a summary of older messages."""
+        """Creates a summary of older messages, without changing the message
+        history.  Returns the index of the first summarised message, the
+        messages from the one before that up to the last summarised one along
+        with their versions, and the summary message, to be passed to
+        apply_ready_summary.  Returns None if there is nothing to summarise."""
         # Keep the last self.assistant.unsummarised_messages messages unsummarised
         messages_to_summarise = self.message_history[1:-self.assistant.unsummarised_messages]  # Skip system prompt
-        recent_messages = self.message_history[-self.assistant.unsummarised_messages:]
 
         # Find the last summary if it exists
         last_summary = None
@@ -141,8 +329,33 @@ class Session:
             to_summarise = messages_to_summarise
 
         if not to_summarise:
-            return
-        
+            return None
+
+        start = 1 + (summary_start_idx if last_summary else 0)
+        end = 1 + len(messages_to_summarise)
+
+        # Once there are enough summaries of one level, they are merged along
+        # with the new one into a summary of the next level, and so on, so
+        # that the number of summaries only grows logarithmically
+        merges = []
+        level = 0
+        while True:
+            first = start
+            while first > 1 and self.message_history[first - 1].is_summary() and \
+                  summary_level(self.message_history[first - 1]) == level:
+                first -= 1
+
+            if start - first + 1 < SUMMARY_MERGE_COUNT:
+                break
+
+            merges.append(self.message_history[first:start])
+            start = first
+            level += 1
+
+        # Remember exactly what is summarised, so that we can tell if it
+        # changes while the summary is being created
+        covered = [(message, message.version) for message in self.message_history[start - 1:end]]
+
         message_log_string = ""
         for message in to_summarise:
             # Ignore system messages with no information
@@ -172,30 +385,44 @@ class Session:
             summary_messages.append(AssistantMessage(last_summary.content))
         summary_messages.append(UserMessage(message_log_string))
 
-        summary = await self.assistant.model.query(summary_messages, system_prompt=SUMMARY_PROMPT)
+        with accounting.caller('summary'):
+            summary = await self.assistant.model.query(summary_messages, system_prompt=SUMMARY_PROMPT)
         # print("Sent to model to summarise: \n", summary_messages)
         # print("Summary of previous messages: ", summary)
 
-        # Create new message history with the summary
-        new_history = [self.message_history[0]]  # Keep system prompt
-        if last_summary:
-            new_history.extend(messages_to_summarise[:summary_start_idx]) # Keep previous summaries
-        new_history.append(AssistantMessage(f"~~~ {summary}"))
-        new_history.extend(recent_messages)
-
-        # Update message history and save to file
-        self.message_history = new_history
-        self._rewrite_message_file()
-
-    def _rewrite_message_file(self):
-        """Rewrites the entire message file with the current message history."""
-        file = self.messages_file
-        if file:
-            file.seek(0)
-            file.truncate()
-            for message in self.message_history:
-                message.dump(file)
-            file.flush()
+        summary_message = AssistantMessage(f"~~~ {summary}")
+        summary_message.summary = SummaryInfo(0, len(to_summarise), to_summarise[0].timestamp, to_summarise[-1].timestamp)
+
+        for level, summaries in enumerate(merges, 1):
+            summary_message = await self.merge_summaries(summaries + [summary_message], level)
+
+        return start, covered, summary_message
+
+    async def merge_summaries(self, summaries, level):
+        """Merges consecutive summaries into one of the given level."""
+
+        merge_log_string = "\n\n".join(summary.content.removeprefix("~~~").strip() for summary in summaries)
+        merge_messages = [SystemMessage(SUMMARY_MERGE_PROMPT), UserMessage(merge_log_string)]
+
+        with accounting.caller('summary'):
+            summary = await self.assistant.model.query(merge_messages, system_prompt=SUMMARY_MERGE_PROMPT)
+
+        summary_message = AssistantMessage(f"~~~ {summary}")
+        summary_message.summary = SummaryInfo.merge([summary.summary for summary in summaries], level)
+        return summary_message
+
+    def plan_context(self, reserved_tokens=0):
+        """Returns the messages to send to the model, fitting within the token
+        budget of the assistant, of which reserved_tokens are already taken up
+        by the system prompt and any other context."""
+
+        messages, report = plan_context(self.message_history,
+                                        budget=self.assistant.context_token_budget,
+                                        full_messages=self.assistant.full_context_messages,
+                                        reserved_tokens=reserved_tokens)
+        print(f"Context: {report}")
+        self.context_report = report
+        return messages
 
     async def chat(self, message: UserMessage, full_context: bool = False) -> AssistantResponse:
         """User or system sends a message.  Returns assistant responses."""
@@ -205,28 +432,30 @@ class Session:
         await self.push_message(message)
         return await self.query_assistant_response(full_context=full_context)
 
-    async def query_assistant_response(self, full_context: bool = False) -> Optional[AssistantResponse]:
+    async def query_assistant_response(self, full_context: bool = False, on_partial=None) -> Optional[AssistantResponse]:
         """Asks the assistant to respond to the current message history,
-        if there are any user messages to respond to, or None."""
+        if there are any user messages to respond to, or None.
 
-        await asyncio.gather(*self.assistant.call_hooks('pre_query_assistant_response', self))
+        If on_partial is given, it is called with the raw response text
+        received so far while the response is being generated."""
 
-        system_prompt = self.system_message.content + \
-                        "\n\n" + \
-                        self.standard_format_prompt
+        await asyncio.gather(*self.assistant.call_hooks('pre_query_assistant_response', self))
 
-        for plugin in self.assistant.plugins.values():
-            for prompt in plugin._dynamic_system_prompts:
-                system_prompt += '\n\n' + prompt(self)
+        # The dynamic prompts change from turn to turn, so they are inserted
+        # just before the new user messages rather than into the system prompt,
+        # which keeps the start of the context cacheable
+        system_prompt, dynamic_prompt = self.prompt_cache.get(self)
 
         responses = []
         async with self.context_lock:
             if self.message_history[-1].role != Role.USER:
                 return
 
-            # Check if we need to summarise before adding new message
+            # Summaries are created in the background, so this turn doesn't
+            # wait for one if it isn't ready yet
             if self.should_summarise():
-                await self.create_summary()
+                self._apply_ready_summary()
+            self.prepare_summary()
 
             # Gather the user messages we are responding to
             user_messages = []
@@ -235,12 +464,27 @@ class Session:
                     break
                 user_messages.insert(0, user_message)
 
+            context = None
+            if dynamic_prompt is not None:
+                context = ContextMessage('SYSTEM: The following is up-to-date context for your next response.\n\n' + dynamic_prompt)
+
             if full_context:
                 messages = self.message_history[:]
             else:
-                messages = [message.reduce() for message in self.message_history[:-5]] + self.message_history[-5:]
-
-            data = await self.assistant.model.query(messages, system_prompt=system_prompt, return_type=dict)
+                reserved_tokens = estimate_tokens(system_prompt)
+                if context:
+                    reserved_tokens += context.estimate_tokens()
+                messages = self.plan_context(reserved_tokens)
+
+            if context:
+                # Insert it before the user messages we're responding to
+                i = len(messages)
+                while i > 1 and messages[i - 1].role == Role.USER:
+                    i -= 1
+                messages.insert(i, context)
+
+            with accounting.caller('chat'):
+                data = await self.assistant.model.query(messages, system_prompt=system_prompt, return_type=dict, on_partial=on_partial)
             assert messages[-1].role == Role.ASSISTANT
 
             new_messages = []
@@ -249,7 +493,8 @@ class Session:
 
             for message in new_messages:
                 self.message_history.append(message)
-                message.dump(self.messages_file)
+                self._index_messages((message, ))
+                self._count_since_summary((message, ))
                 data = message.parse_json()
                 response = AssistantResponse(self, data, user_messages, thought=message.thought)
                 for query, results in message.searches:
@@ -257,13 +502,22 @@ class Session:
                     response.actions_taken.append(f'Ran search for "{query}" with results {results_formatted}')
 
                 responses.append(response)
-            self.messages_file.flush()
+
+            if self.journal:
+                self.journal.append(new_messages)
+                self.journal.flush()
+
+            self.prepare_summary()
 
         return responses
 
     async def isolated_query(self, query, attachments=[], *, format_prompt=None,
-                             return_type=str, model=None, full_context=True):
-        # Runs an isolated query on this session.
+                             return_type=str, model=None, full_context=True,
+                             cache=True, caller=None):
+        # Runs an isolated query on this session.  If the assistant has a
+        # response cache, an identical earlier query is answered from it,
+        # unless cache is False.  The caller is used to tag the model call
+        # in the usage log.
         system_prompt = self.message_history[0].content
 
         if format_prompt:
@@ -272,17 +526,29 @@ class Session:
         print("Isolated query:", query)
 
         message = UserMessage(query)
-        message.attachments[:] = attachments
+        message.attachments = list(attachments)
 
         if full_context:
             messages = self.message_history
         else:
-            messages = [message.reduce() for message in self.message_history[:-5]] + self.message_history[-5:]
+            messages = self.plan_context(estimate_tokens(system_prompt) + message.estimate_tokens())
         messages = messages + [message]
 
         if model is None:
             model = self.assistant.model
-        response = await model.query(messages, system_prompt=system_prompt, return_type=return_type)
+
+        response_cache = self.assistant.response_cache if cache else None
+        if response_cache is not None:
+            key = response_cache.make_key(model.model_name, system_prompt, messages, return_type, model.temperature)
+            response = response_cache.get(key)
+            if response is not None:
+                print("Cached response:", response)
+                return response
+
+        with accounting.caller(caller or 'isolated_query'):
+            response = await model.query(messages, system_prompt=system_prompt, return_type=return_type)
+        if response_cache is not None:
+            response_cache.put(key, response)
 
         print("Response:", response)
         return response
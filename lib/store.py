@@ -0,0 +1,279 @@
+"""Stores the sessions of an assistant in an SQLite database, as an alternative
+to the .jsonl session journals.  Loading a session only reads the metadata of
+its messages; their content and thoughts are read from the database when they
+are first accessed, so that looking at part of a long session is cheap.
+Sessions can be imported from and exported to the .jsonl format.
+
+Changes are written and committed by the writer thread of the journals, over
+a connection of its own, so the event loop only reads from the database.  It
+is kept in WAL mode, so committing a change only appends it to the log.  The
+durability policies of the journals (see lib/journal.py) apply here too:
+under "message" every commit is fsynced, under "group" the log is synced by a
+checkpoint at most group_commit_interval seconds after a commit, and under
+"rollover" only when the session is closed, or when SQLite checkpoints the
+log by itself."""
+
+import asyncio
+import concurrent.futures
+import json
+import sqlite3
+import time
+from datetime import date, datetime, timezone
+
+from . import journal
+from .msgtypes import message_from_dict
+
+
+def _message_row(message):
+    obj = message.to_dict()
+    content = obj.pop("content")
+    thought = obj.pop("thought", None)
+    return json.dumps(obj), int(message.is_summary()), content, thought
+
+
+class SessionDatabase:
+    """The database holding all sessions of one assistant."""
+
+    def __init__(self, path, durability=journal.DEFAULT_DURABILITY, group_commit_interval=journal.GROUP_COMMIT_INTERVAL):
+        assert durability in journal.DURABILITY_POLICIES, f"Invalid durability policy '{durability}'"
+
+        self.path = path
+        self.durability = durability
+        self.group_commit_interval = group_commit_interval
+
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS sessions (
+            date TEXT PRIMARY KEY, modified REAL)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS messages (
+            key INTEGER PRIMARY KEY AUTOINCREMENT, session TEXT, ordinal REAL,
+            meta TEXT, is_summary INTEGER, content TEXT, thought TEXT)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS messages_order ON messages (session, ordinal)")
+        self.db.commit()
+
+        # Keys are handed out here rather than by the inserts, which are only
+        # done later by the writer thread
+        row = self.db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'").fetchone()
+        self.next_key = (row[0] if row else 0) + 1
+
+        # Whether anything was submitted since the writer thread was last
+        # waited for
+        self.unwritten = False
+
+        # Only used by the writer thread
+        self._db = None
+        self._deadline = None
+
+    def allocate_key(self):
+        key = self.next_key
+        self.next_key += 1
+        return key
+
+    def submit(self, statements):
+        """Has the given (sql, parameters) pairs executed and committed by
+        the writer thread."""
+
+        journal.writer.submit(self, 'write', statements)
+        self.unwritten = True
+
+    def wait_committed(self):
+        """Blocks until everything submitted so far has been committed."""
+
+        self.unwritten = False
+        future = concurrent.futures.Future()
+        journal.writer.submit(self, 'wait', future)
+        future.result()
+
+    def catch_up(self):
+        """Makes sure that reads see the changes submitted so far.  This
+        only blocks if the writer thread hasn't been waited for since."""
+
+        if self.unwritten:
+            self.wait_committed()
+
+    def has_session(self, date):
+        self.catch_up()
+        return self.db.execute("SELECT 1 FROM sessions WHERE date = ?", (date.isoformat(), )).fetchone() is not None
+
+    def session_dates(self):
+        self.catch_up()
+        return [date.fromisoformat(row[0]) for row in self.db.execute("SELECT date FROM sessions")]
+
+    def load(self, date):
+        """Returns the messages of the session on the given date, with their
+        content not yet loaded, a SessionStore to record changes to them in,
+        and the time the session was last modified."""
+
+        self.catch_up()
+        row = self.db.execute("SELECT modified FROM sessions WHERE date = ?", (date.isoformat(), )).fetchone()
+        if row is None:
+            return None
+
+        modified = datetime.fromtimestamp(row[0], tz=timezone.utc)
+
+        messages = []
+        store = SessionStore(self, date)
+        # The length of the content lets the tokens since the last summary
+        # be counted without loading it
+        rows = self.db.execute("SELECT key, ordinal, meta, is_summary, length(content) FROM messages WHERE session = ? ORDER BY ordinal", (date.isoformat(), ))
+        for key, ordinal, meta, is_summary, length in rows:
+            message = message_from_dict(json.loads(meta) | {"content": None})
+            message.set_lazy_content(lambda key=key: self.load_content(key), bool(is_summary), length or 0)
+            messages.append(message)
+            store.keys.append(key)
+            store.ordinals.append(ordinal)
+
+        return messages, store, modified
+
+    def load_content(self, key):
+        """Returns the content and thought of the given message."""
+
+        row = self.db.execute("SELECT content, thought FROM messages WHERE key = ?", (key, )).fetchone()
+        if row is None:
+            # The message was deleted
+            return "", None
+        return row
+
+    def create(self, date):
+        """Creates an empty session and returns its SessionStore.  The
+        session is written along with the first flush of the store."""
+
+        store = SessionStore(self, date)
+        store.statements.append(("INSERT INTO sessions VALUES (?, ?)", (date.isoformat(), time.time())))
+        return store
+
+    def import_jsonl(self, date, path):
+        """Imports the session on the given date from a .jsonl file,
+        replacing it if it already exists."""
+
+        with open(path, 'r') as fh:
+            messages, records = journal.replay(fh)
+
+        self.submit([("DELETE FROM messages WHERE session = ?", (date.isoformat(), )),
+                     ("DELETE FROM sessions WHERE date = ?", (date.isoformat(), ))])
+        store = self.create(date)
+        store.append(messages)
+        store.flush()
+
+    def export_jsonl(self, date, path):
+        """Writes the session on the given date to a .jsonl file.  Returns
+        False if there is no such session."""
+
+        result = self.load(date)
+        if result is None:
+            return False
+
+        messages, store, modified = result
+        with open(path, 'w') as fh:
+            for message in messages:
+                message.dump(fh)
+
+        return True
+
+    # The following are called by the writer thread
+
+    def _write(self, statements):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path)
+            self._db.execute("PRAGMA synchronous=FULL" if self.durability == 'message' else "PRAGMA synchronous=NORMAL")
+
+        for sql, parameters in statements:
+            self._db.execute(sql, parameters)
+
+    def _flush(self):
+        if self._db is not None:
+            self._db.commit()
+
+    def _sync(self):
+        if self._db is not None:
+            self._db.commit()
+
+            # Under "message" the commit was already synced, otherwise
+            # checkpointing syncs the log first
+            if self.durability != 'message':
+                self._db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def _close(self):
+        if self._db is not None:
+            self._db.commit()
+            self._db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+
+class SessionStore:
+    """Records changes to the messages of one session in the database, in
+    the same way as a SessionJournal.  Changes are handed to the writer
+    thread by flush(), and made durable according to the durability policy of
+    the database."""
+
+    def __init__(self, db, date):
+        self.db = db
+        self.session = date.isoformat()
+
+        # Keys and ordinals of the rows of the messages, in order
+        self.keys = []
+        self.ordinals = []
+
+        # Statements not yet handed to the writer
+        self.statements = []
+
+    def __insert(self, message, ordinal):
+        key = self.db.allocate_key()
+        self.statements.append(("INSERT INTO messages (key, session, ordinal, meta, is_summary, content, thought) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (key, self.session, ordinal) + _message_row(message)))
+        return key
+
+    def append(self, messages):
+        for message in messages:
+            ordinal = self.ordinals[-1] + 1.0 if self.ordinals else 1.0
+            self.keys.append(self.__insert(message, ordinal))
+            self.ordinals.append(ordinal)
+
+    def edit(self, index, message):
+        self.statements.append(("UPDATE messages SET meta = ?, is_summary = ?, content = ?, thought = ? WHERE key = ?",
+                                _message_row(message) + (self.keys[index], )))
+
+    def delete(self, index):
+        self.statements.append(("DELETE FROM messages WHERE key = ?", (self.keys[index], )))
+        del self.keys[index]
+        del self.ordinals[index]
+
+    def replace_range(self, start, end, messages):
+        self.statements.extend(("DELETE FROM messages WHERE key = ?", (key, )) for key in self.keys[start:end])
+
+        # Fit the new rows in between the neighbouring ones
+        low = self.ordinals[start - 1] if start > 0 else 0.0
+        high = self.ordinals[end] if end < len(self.ordinals) else low + len(messages) + 1.0
+        step = (high - low) / (len(messages) + 1)
+        ordinals = [low + step * (i + 1) for i in range(len(messages))]
+        keys = [self.__insert(message, ordinal) for message, ordinal in zip(messages, ordinals)]
+
+        self.keys[start:end] = keys
+        self.ordinals[start:end] = ordinals
+
+    def flush(self):
+        if self.statements:
+            self.statements.append(("UPDATE sessions SET modified = ? WHERE date = ?", (time.time(), self.session)))
+            self.db.submit(self.statements)
+            self.statements = []
+
+    async def wait_written(self):
+        """Waits until everything recorded so far has been committed, and
+        synced under the "message" policy."""
+
+        self.flush()
+        future = concurrent.futures.Future()
+        journal.writer.submit(self.db, 'wait', future)
+        await asyncio.wrap_future(future)
+
+    async def close(self):
+        """Waits until everything recorded so far has been committed and
+        synced."""
+
+        self.flush()
+        future = concurrent.futures.Future()
+        journal.writer.submit(self.db, 'close', future)
+        await asyncio.wrap_future(future)
+
+    def maybe_compact(self, messages):
+        # Nothing to compact
+        pass
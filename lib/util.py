@@ -2,6 +2,9 @@ import json
 import asyncio
 import re
 
+# Rough average number of characters per token, for estimating token counts
+CHARS_PER_TOKEN = 4
+
 EMOJI_MODIFIERS = '\ufe0f\ufe0e\U0001f3fb\U0001f3fc\U0001f3fd\U0001f3fe\U0001f3ff' \
                 +  ''.join(chr(i) for i in range(0xe0020, 0xe0080))
 
@@ -80,6 +83,17 @@ def split_emoji(string):
         yield char
 
 
+def estimate_tokens(text):
+    """Returns a rough estimate of the number of tokens in the given text."""
+    return estimate_tokens_for_length(len(text)) if text else 0
+
+
+def estimate_tokens_for_length(length):
+    """Returns a rough estimate of the number of tokens in a text of the given
+    number of characters."""
+    return (length + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
 def format_json_md(data):
     code = json.dumps(data, indent=4).replace('```', '\\u0060\\u0060\\u0060')
     return f'```json\n{code}\n```'
@@ -55,6 +55,6 @@ class EditSystemPromptModal(discord.ui.Modal, title='Edit System Prompt for Toda
 
         async with self.session.context_lock:
             self.session.system_message.content = new_prompt
-            self.session._rewrite_message_file()
+            self.session.update_message(self.session.system_message)
 
         await interaction.response.send_message(f'Updated system prompt.', ephemeral=True, silent=True)
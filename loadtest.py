@@ -0,0 +1,146 @@
+"""Replays the user messages of archived sessions through the fake model at a
+fixed rate, and reports how long it took for each message to be answered.
+This exercises the session and plugin code without any network access.
+
+For example, to replay all sessions at 5 messages per second against a model
+that takes half a second to respond and fails 5% of the time:
+
+    python loadtest.py --rate 5 --latency 0.5 --error-rate 0.05 'sessions/*.jsonl'
+"""
+
+import argparse
+import asyncio
+import glob
+import time
+from datetime import date
+
+from lib import models, accounting, journal
+from lib.accounting import percentile
+from lib.assistant import Assistant
+from lib.session import Session
+from lib.msgtypes import Role, UserMessage
+
+
+def load_archive(path):
+    """Returns the system prompt and the user messages of the given session
+    file."""
+
+    system_prompt = ''
+    user_messages = []
+    with open(path, 'r') as fh:
+        messages, records = journal.replay(fh)
+
+    for message in messages:
+        if message.role == Role.SYSTEM and not system_prompt:
+            system_prompt = message.content
+        elif message.role == Role.USER:
+            user_messages.append(message)
+
+    return system_prompt, user_messages
+
+
+class Replay:
+    """Replays the user messages of one archived session, in order."""
+
+    def __init__(self, assistant, path, stats):
+        system_prompt, self.messages = load_archive(path)
+        self.path = path
+        self.stats = stats
+        self.queue = asyncio.Queue()
+
+        self.session = Session(date.today(), assistant, system_prompt)
+
+    async def run(self):
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+
+            archived, release_time = item
+            message = UserMessage(archived.content)
+            for attach in archived.attachments:
+                message.attach(attach.url, attach.content_type)
+
+            try:
+                await self.session.chat(message)
+            except Exception as ex:
+                print(f"{self.path}: {ex}")
+                self.stats['errors'] += 1
+            else:
+                self.stats['latencies'].append(time.monotonic() - release_time)
+
+
+async def run(args):
+    def create_model(model_name='fake'):
+        return models.FakeModel(model_name, latency=args.latency, error_rate=args.error_rate, token_rate=args.token_rate, seed=args.seed)
+
+    if args.assistant:
+        # Make sure the plugins don't get to talk to a real model either
+        models.create = create_model
+        assistant = Assistant.load(args.assistant)
+        await assistant.load_plugins()
+    else:
+        assistant = Assistant('loadtest', create_model())
+
+    # Keep the fake calls out of the real usage log
+    accounting.usage_log = accounting.UsageLog(':memory:')
+
+    stats = {'latencies': [], 'errors': 0}
+    replays = [Replay(assistant, path, stats) for path in sorted(glob.glob(args.sessions))]
+    replays = [replay for replay in replays if replay.messages]
+    if not replays:
+        print(f"No user messages found in {args.sessions}")
+        return
+
+    # Interleave the messages of the various sessions
+    schedule = []
+    for i in range(max(len(replay.messages) for replay in replays)):
+        for replay in replays:
+            if i < len(replay.messages):
+                schedule.append((replay, replay.messages[i]))
+    if args.limit:
+        schedule = schedule[:args.limit]
+
+    print(f"Replaying {len(schedule)} messages from {len(replays)} sessions at {args.rate} messages per second")
+
+    workers = [asyncio.create_task(replay.run()) for replay in replays]
+    start_time = time.monotonic()
+    for i, (replay, message) in enumerate(schedule):
+        release_time = start_time + i / args.rate
+        delay = release_time - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        replay.queue.put_nowait((message, release_time))
+
+    for replay in replays:
+        replay.queue.put_nowait(None)
+    await asyncio.gather(*workers)
+    duration = time.monotonic() - start_time
+
+    latencies = stats['latencies']
+    print(f"Answered {len(latencies)} messages in {duration:.1f} seconds ({len(latencies) / duration:.2f} per second), {stats['errors']} failed")
+    if latencies:
+        print(f"Latency: p50 {percentile(latencies, 0.5):.3f}s, p90 {percentile(latencies, 0.9):.3f}s, p99 {percentile(latencies, 0.99):.3f}s, max {max(latencies):.3f}s")
+
+    print("Model calls:")
+    for line in accounting.format_summary(accounting.usage_log.summarise()):
+        print(f"  {line}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays archived sessions through the fake model and reports response latencies.")
+    parser.add_argument("sessions", nargs='?', default='sessions/*.jsonl', help="glob pattern matching the session files to replay")
+    parser.add_argument("--rate", type=float, default=1.0, help="number of messages to send per second")
+    parser.add_argument("--limit", type=int, help="maximum number of messages to send")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before the fake model starts responding")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of fake model requests that fail")
+    parser.add_argument("--token-rate", type=float, default=0.0, help="tokens per second generated by the fake model (0 for instant)")
+    parser.add_argument("--seed", type=int, default=0, help="seed used to decide which requests fail")
+    parser.add_argument("--assistant", help="name of the .toml file of an assistant whose plugins to load, without .toml extension")
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
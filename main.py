@@ -2,11 +2,9 @@ import sys, os
 from contextlib import contextmanager
 import argparse
 import asyncio
-import discord
 import json
 
 from lib.assistant import Assistant
-from lib.bot import Bot
 from lib.msgtypes import UserMessage
 
 
@@ -33,6 +31,10 @@ async def run_local(assistant, session_date):
 
 
 def run_discord_bot(assistant, session_date, token):
+    # Imported here so that running locally doesn't import discord, unless
+    # one of the plugins needs it
+    from lib.bot import Bot
+
     bot = Bot(assistant, session_date)
     bot.run(token)
 
@@ -1,9 +1,13 @@
 import asyncio
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 
 from lib.plugin import Plugin, hook, action, system_prompt
 from lib.msgtypes import Attachment
-from lib import models
+from lib import ratelimit
+
+# Image generation has its own rate limits at OpenAI, which can be configured
+# with $OPENAI_IMAGES_REQUESTS_PER_MINUTE and $OPENAI_IMAGES_MAX_CONCURRENT
+LIMITER_KEY = 'openai-images'
 
 
 class DallEPlugin(Plugin):
@@ -13,10 +17,10 @@ class DallEPlugin(Plugin):
     async def on_configure(self, config):
         self.model_name = config.get('model', 'dall-e-2')
 
-        if isinstance(self.assistant.model, models.OpenAIModel):
-            self.client = self.assistant.model.client
-        else:
-            self.client = AsyncOpenAI()
+        # Not shared with the chat model, so that the rate limit headers of
+        # the responses go to the right limiter
+        http_client = DefaultAsyncHttpxClient(event_hooks=ratelimit.httpx_event_hooks(LIMITER_KEY))
+        self.client = AsyncOpenAI(http_client=http_client)
 
     @system_prompt
     def on_system_prompt(self, session):
@@ -53,12 +57,13 @@ class DallEPlugin(Plugin):
             response.attach(await fut)
 
     async def generate_image(self, prompt: str, size: str, quality: str = "standard", style: str = "natural"):
-        response = await self.client.images.generate(
-            model=self.model_name,
-            prompt=prompt,
-            size=size,
-            quality=quality,
-            style=style,
-            n=1)
+        async with ratelimit.get_limiter(LIMITER_KEY).acquire():
+            response = await self.client.images.generate(
+                model=self.model_name,
+                prompt=prompt,
+                size=size,
+                quality=quality,
+                style=style,
+                n=1)
 
         return Attachment(response.data[0].url, "image/png")
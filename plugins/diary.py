@@ -1,8 +1,9 @@
-from lib.plugin import Plugin, hook, discord_command
+from lib.plugin import Plugin, hook, discord_command, batch_continuation
 from lib.msgtypes import Channel
 
 import discord
 import pathlib
+from datetime import date
 
 DIARIES_DIR = pathlib.Path(__file__).parent.parent.resolve() / 'diaries'
 
@@ -20,6 +21,16 @@ class DiaryPlugin(Plugin):
 
     @hook('post_session_end')
     async def on_post_session_end(self, session):
+        path = self._get_entry_path(session)
+        if not path.exists():
+            await self.run_batch_job(self.write_batched_entry, session.date.isoformat())
+
+    @batch_continuation
+    async def write_batched_entry(self, session_date):
+        session = self.assistant.load_existing_session(date.fromisoformat(session_date))
+        if session is None:
+            return
+
         path = self._get_entry_path(session)
         if not path.exists():
             entry = await self._write_diary_entry(session, batch=True)
@@ -31,7 +42,7 @@ class DiaryPlugin(Plugin):
     async def _write_diary_entry(self, session, overwrite=True, batch=False):
         path = self._get_entry_path(session)
 
-        fut = session.isolated_query("SYSTEM: " + self.prompt)
+        fut = session.isolated_query("SYSTEM: " + self.prompt, caller='diary')
         if batch:
             response, = await self.assistant.model.batch(fut)
         else:
@@ -45,6 +56,7 @@ class DiaryPlugin(Plugin):
         with open(path, 'w') as fh:
             fh.write(response)
 
+        self.assistant.record_session(session, diary=True)
         return response
 
     @discord_command(name="diary_entry_write",
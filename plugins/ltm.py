@@ -1,4 +1,4 @@
-from lib.plugin import Plugin, hook, system_prompt, discord_command
+from lib.plugin import Plugin, hook, system_prompt, discord_command, batch_continuation
 from lib.msgtypes import Channel
 from lib import models
 
@@ -51,7 +51,7 @@ class Memory:
 
 
 class LongTermMemoryPlugin(Plugin):
-    @system_prompt(dynamic=True)
+    @system_prompt(dynamic='versioned')
     def dynamic_system_prompt(self, session):
         return ''.join(f'## Long-Term Memory M{memory.id:04}: {memory.title}\n{memory.content}\n\n' for memory in self.active_memories)
 
@@ -95,13 +95,14 @@ class LongTermMemoryPlugin(Plugin):
 
         prompt = f"SYSTEM: Respond with a JSON list (and nothing else) containing the IDs of up to {self.max_active_memories} of the long-term memories that are most relevant to the current conversation. If none are relevant, respond with an empty list."
 
-        result = await session.isolated_query(prompt, format_prompt=extra_prompt, return_type=list, model=self.recall_model)
+        result = await session.isolated_query(prompt, format_prompt=extra_prompt, return_type=list, model=self.recall_model, caller='ltm_recall')
         if isinstance(result, dict):
             if 'relevant_memories' in result:
                 result = result['relevant_memories']
             elif len(result) == 1:
                 result = next(iter(result.values()))
 
+        old_active_memories = set(self.active_memories)
         self.active_memories.clear()
         for mem_id in result or ():
             if isinstance(mem_id, dict):
@@ -114,6 +115,9 @@ class LongTermMemoryPlugin(Plugin):
             if memory:
                 self.active_memories.add(memory)
 
+        if self.active_memories != old_active_memories:
+            self.system_prompt_changed()
+
         if not self.active_memories:
             asyncio.create_task(self.send_message('No memories activated.', channel=Channel.LOG))
         else:
@@ -125,7 +129,13 @@ class LongTermMemoryPlugin(Plugin):
 
     @hook('post_session_end')
     async def on_post_session_end(self, session):
-        self.schedule(None, self.update_memories(session))
+        self.schedule(None, self.run_batch_job(self.update_batched_memories, session.date.isoformat()))
+
+    @batch_continuation
+    async def update_batched_memories(self, session_date):
+        session = self.assistant.load_existing_session(date.fromisoformat(session_date))
+        if session is not None:
+            await self.update_memories(session, batch=True)
 
     async def update_memories(self, session, batch=True):
         print("Updating memories")
@@ -137,7 +147,7 @@ class LongTermMemoryPlugin(Plugin):
             for memory in self.memories_by_id.values():
                 extra_prompt += f'{memory}\n'
 
-        update_ids = await session.isolated_query("SYSTEM: Are there any long-term memories in your list you wish to update based on today's chat? Respond with a JSON list of the identifiers of the memories that you wish to update. It's okay to return an empty list if nothing needs to be updated.", format_prompt=extra_prompt, return_type=list, model=self.update_model)
+        update_ids = await session.isolated_query("SYSTEM: Are there any long-term memories in your list you wish to update based on today's chat? Respond with a JSON list of the identifiers of the memories that you wish to update. It's okay to return an empty list if nothing needs to be updated.", format_prompt=extra_prompt, return_type=list, model=self.update_model, caller='ltm_update')
         if not update_ids:
             update_ids = []
         elif isinstance(update_ids, dict):
@@ -170,7 +180,7 @@ class LongTermMemoryPlugin(Plugin):
                 "labels": memory.labels
             }
             old_json = json.dumps(old_data, indent=4)
-            query = session.isolated_query(f"SYSTEM: Now follows the full definition of memory M{update_id:04d}. Return this same JSON object, but appropriately modified if you have learned new information about this topic. Also include a \"commit_message\" string in that same object explaining what has changed. Remember, the memory content should be removed from time, make sure that it still makes sense when read on any date in the future, and important events should include a date in the text.\n{old_json}", format_prompt=extra_prompt, return_type=dict, model=self.update_model)
+            query = session.isolated_query(f"SYSTEM: Now follows the full definition of memory M{memory.id:04d}. Return this same JSON object, but appropriately modified if you have learned new information about this topic. Also include a \"commit_message\" string in that same object explaining what has changed. Remember, the memory content should be removed from time, make sure that it still makes sense when read on any date in the future, and important events should include a date in the text.\n{old_json}", format_prompt=extra_prompt, return_type=dict, model=self.update_model, caller='ltm_update')
             update_queries.append(query)
 
         if batch:
@@ -200,7 +210,7 @@ class LongTermMemoryPlugin(Plugin):
         else:
             updated_msg = ''
 
-        query = session.isolated_query(f"SYSTEM:{updated_msg} Besides that, are there any new things, unrelated to these or any other existing memories, that you wish to commit to long term memory for later recall, for example detailing the current state of a project or pursuit, or a particularly significant conversation? Return a JSON list of memories, each memory being a JSON object with a \"title\" key, a brief \"summary\", the full \"content\" (be detailed!) and a list of \"labels\". Memories are not for diary entries, so do not create a memory just describing the day or energy patterns. It's okay to not create any memories if there are no new things unrelated to existing memories. If you mention particular events, include a date on which that event occurred in the text. The memory content should be removed from time, make sure that it still makes sense when read on any date in the future. Be very, very thorough to make sure you've included all the important details that were brought up today regarding this topic.", format_prompt=extra_prompt, return_type=list, model=self.update_model)
+        query = session.isolated_query(f"SYSTEM:{updated_msg} Besides that, are there any new things, unrelated to these or any other existing memories, that you wish to commit to long term memory for later recall, for example detailing the current state of a project or pursuit, or a particularly significant conversation? Return a JSON list of memories, each memory being a JSON object with a \"title\" key, a brief \"summary\", the full \"content\" (be detailed!) and a list of \"labels\". Memories are not for diary entries, so do not create a memory just describing the day or energy patterns. It's okay to not create any memories if there are no new things unrelated to existing memories. If you mention particular events, include a date on which that event occurred in the text. The memory content should be removed from time, make sure that it still makes sense when read on any date in the future. Be very, very thorough to make sure you've included all the important details that were brought up today regarding this topic.", format_prompt=extra_prompt, return_type=list, model=self.update_model, caller='ltm_update')
         if batch:
             new_memories, = await session.assistant.model.batch(query)
         else:
@@ -231,6 +241,8 @@ class LongTermMemoryPlugin(Plugin):
             self.memories_by_id[memory.id] = memory
             await self.update_memory(memory)
 
+        self.assistant.record_session(session, ltm=True)
+
         print(f"Finished updating memories (added {len(new_memories)} new, updated {len(update_memories)})")
         return len(new_memories), len(update_memories)
 
@@ -258,6 +270,9 @@ class LongTermMemoryPlugin(Plugin):
                     await self.update_memory(memory)
 
     async def update_memory(self, memory):
+        if memory in self.active_memories:
+            self.system_prompt_changed()
+
         if not self.discord_channel:
             return
 
@@ -287,7 +302,9 @@ class LongTermMemoryPlugin(Plugin):
         if memory.id in self.memories_by_id:
             del self.memories_by_id[memory.id]
 
-        self.active_memories.discard(memory)
+        if memory in self.active_memories:
+            self.active_memories.discard(memory)
+            self.system_prompt_changed()
         self.save_memories()
 
         if not memory.message_id:
@@ -168,7 +168,7 @@ class RemindersPlugin(Plugin):
             'will remove all future repetitions as well!'
         )
 
-    @system_prompt(dynamic=True)
+    @system_prompt(dynamic='versioned')
     def dynamic_system_prompt(self, session):
         result = ['# Currently scheduled reminders:']
 
@@ -312,6 +312,7 @@ class RemindersPlugin(Plugin):
         # Remove the reminder from the list
         if reminder in self.reminders:
             self.reminders.remove(reminder)
+            self.system_prompt_changed()
 
         begin_time = datetime.now(tz=timezone.utc)
         print(f'Responding to reminder R{reminder.id:03} for {reminder.time}: {reminder.text}')
@@ -357,6 +358,7 @@ class RemindersPlugin(Plugin):
                     self.next_id += 1
 
             self.reminders = reminders
+            self.system_prompt_changed()
 
             if num_dupes > 0:
                 print(f'Removed {num_dupes} duplicate reminders')
@@ -365,6 +367,8 @@ class RemindersPlugin(Plugin):
                 self.save_reminders()
 
     def save_reminders(self):
+        self.system_prompt_changed()
+
         # The time needs to be converted to a string since datetime isn't compatible with JSON
         with self.assistant.open_memory_file('reminders.json', 'w', default='[]') as f:
             f.write('[\n')
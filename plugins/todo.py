@@ -39,7 +39,7 @@ class TodoPlugin(Plugin):
             '"remove".'
         )
 
-    @system_prompt(dynamic=True)
+    @system_prompt(dynamic='versioned')
     def on_dynamic_system_prompt(self, session):
         with self.assistant.open_memory_file('todo.json') as fh:
             todo_json = fh.read()
@@ -99,6 +99,7 @@ class TodoPlugin(Plugin):
         # Write the dict back to file
         with self.assistant.open_memory_file('todo.json', 'w') as fh:
             json.dump(todos_list, fh)
+        self.system_prompt_changed()
 
         # Update the pinned to do message in the background
         asyncio.create_task(self.todo_list_message.update())
@@ -142,6 +143,7 @@ class EditTodosModal(discord.ui.Modal, title='Edit Todos'):
 
         with self.bot.assistant.open_memory_file('todo.json', 'w', default='[]') as fh:
             json.dump(value, fh, indent=4)
+        self.plugin.system_prompt_changed()
 
         await interaction.response.send_message(f'Updated todo.json', ephemeral=True, silent=True, delete_after=0.001)
 
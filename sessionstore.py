@@ -0,0 +1,67 @@
+"""Imports sessions from .jsonl files into the session database of an
+assistant, or exports them from it, for assistants with session_store set to
+"sqlite", or lists the sessions of an assistant from the session manifest:
+
+    python sessionstore.py import cosmo sessions/cosmo-2025-01-31.jsonl
+    python sessionstore.py export cosmo 2025-01-31 cosmo-2025-01-31.jsonl
+    python sessionstore.py list cosmo
+"""
+
+import argparse
+import sys
+from datetime import date
+
+from lib.assistant import SESSION_DIR
+from lib.store import SessionDatabase
+from lib.manifest import SessionManifest
+
+
+def format_flag(value):
+    return '?' if value is None else 'yes' if value else 'no'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Imports, exports or lists the sessions of an assistant.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser("import", help="import .jsonl session files")
+    import_parser.add_argument("assistant", help="identifier of the assistant")
+    import_parser.add_argument("files", nargs='+', help=".jsonl files named after the date of the session")
+
+    export_parser = subparsers.add_parser("export", help="export a session to a .jsonl file")
+    export_parser.add_argument("assistant", help="identifier of the assistant")
+    export_parser.add_argument("date", type=date.fromisoformat, help="date of the session")
+    export_parser.add_argument("file", help="file to write")
+
+    list_parser = subparsers.add_parser("list", help="list the sessions in the session manifest")
+    list_parser.add_argument("assistant", help="identifier of the assistant")
+
+    args = parser.parse_args()
+
+    SESSION_DIR.mkdir(exist_ok=True)
+
+    if args.command == 'list':
+        # Sessions are added to the manifest as they are written
+        for info in SessionManifest(SESSION_DIR / 'manifest.sqlite').list(args.assistant):
+            last_activity = info['last_activity'].astimezone().strftime('%Y-%m-%d %H:%M') if info['last_activity'] else '?'
+            print(f"{info['date']}: {info['messages']} messages, last activity {last_activity}, "
+                  f"summary {format_flag(info['summary'])}, diary {format_flag(info['diary'])}, ltm {format_flag(info['ltm'])}")
+        return
+
+    db = SessionDatabase(SESSION_DIR / f'{args.assistant}.sqlite')
+
+    if args.command == 'import':
+        for path in args.files:
+            # Session files are named like cosmo-2025-01-31.jsonl
+            session_date = date.fromisoformat(path.removesuffix('.jsonl')[-10:])
+            db.import_jsonl(session_date, path)
+            print(f"Imported {path} as session of {session_date}")
+
+    elif args.command == 'export':
+        if not db.export_jsonl(args.date, args.file):
+            print(f"No session on {args.date}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+"""Summarises the token usage and latency of the model calls recorded in the
+usage database, grouped by what they were made for.
+
+    python usagereport.py --days 7
+    python usagereport.py --by model
+"""
+
+import argparse
+import time
+
+from lib import accounting
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarises the recorded model usage.")
+    parser.add_argument("--days", type=float, default=1.0, help="number of days to look back")
+    parser.add_argument("--by", choices=('caller', 'model', 'provider'), default='caller', help="how to group the calls")
+    args = parser.parse_args()
+
+    since = time.time() - args.days * 86400
+    lines = accounting.format_summary(accounting.get_usage_log().summarise(since, group_by=args.by))
+    if not lines:
+        print("No model calls have been made in this period.")
+
+    for line in lines:
+        print(line)
+
+
+if __name__ == '__main__':
+    main()